@@ -0,0 +1,108 @@
+"""
+Compares the streaming UZH menu extractor with the previous BeautifulSoup parser.
+
+    python benchmark_uni_parser.py                 # today's pages of all UZH mensas
+    python benchmark_uni_parser.py page.html ...   # recorded pages
+    python benchmark_uni_parser.py --offline       # the pages in benchmark_pages/
+    python benchmark_uni_parser.py --save pages/   # record today's pages as fixtures
+"""
+import argparse
+import glob
+import os
+import sys
+import timeit
+import urllib.request
+
+from bs4 import BeautifulSoup
+
+from botBase import mensa_helpers
+
+FIXTURES_DIR = os.path.join(os.path.dirname(__file__), "benchmark_pages")
+
+
+def beautifulsoup_parse(raw_data):
+    soup = BeautifulSoup(raw_data, "html.parser")
+    menu_holder = soup.find("div", {"class": "NewsListItem--content"})
+    lines = menu_holder.text.split("\n")
+
+    menus = []
+    for i, line in enumerate(lines):
+        if " | " not in line:
+            continue
+        try:
+            prices = line.split(" | ")[1].split(" / ")
+            menus.append(
+                (
+                    line.split(" | ")[0],
+                    [price.replace("CHF", "").replace(" ", "") for price in prices[:3]],
+                    lines[i + 1].split("  "),
+                )
+            )
+        except IndexError:
+            break
+    return menus
+
+
+def extractor_parse(raw_data):
+    return [
+        (
+            meal.label,
+            [meal.price_student, meal.price_staff, meal.price_extern],
+            list(meal.description),
+        )
+        for meal in mensa_helpers.parse_uni_page(raw_data)
+    ]
+
+
+def fetch_pages():
+    pages = {}
+    for mensa in mensa_helpers.available:
+        if not isinstance(mensa, mensa_helpers.UniMensa):
+            continue
+        date, mealtime, url = mensa_helpers.resolve_source(mensa)
+        with urllib.request.urlopen(url) as request:
+            pages[f"{mensa.key}-{date}-{mealtime}.html"] = request.read().decode("utf8")
+    return pages
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("pages", nargs="*", help="recorded menu pages")
+    parser.add_argument("--save", help="directory to record the fetched pages in")
+    parser.add_argument(
+        "--offline", action="store_true", help=f"use the pages in {FIXTURES_DIR}"
+    )
+    parser.add_argument("--number", type=int, default=20)
+    args = parser.parse_args()
+
+    paths = args.pages
+    if args.offline:
+        paths += sorted(glob.glob(os.path.join(FIXTURES_DIR, "*.html")))
+    if paths:
+        pages = {}
+        for path in paths:
+            with open(path, encoding="utf8") as f:
+                pages[os.path.basename(path)] = f.read()
+    else:
+        pages = fetch_pages()
+
+    if args.save:
+        os.makedirs(args.save, exist_ok=True)
+        for name, raw_data in pages.items():
+            with open(os.path.join(args.save, name), "w", encoding="utf8") as f:
+                f.write(raw_data)
+
+    differ = False
+    for name, raw_data in pages.items():
+        same = beautifulsoup_parse(raw_data) == extractor_parse(raw_data)
+        old = timeit.timeit(lambda: beautifulsoup_parse(raw_data), number=args.number)
+        new = timeit.timeit(lambda: extractor_parse(raw_data), number=args.number)
+        print(
+            f"{name}: {len(raw_data) / 1000:.0f}kB "
+            + f"beautifulsoup {old / args.number * 1000:.2f}ms "
+            + f"extractor {new / args.number * 1000:.2f}ms "
+            + f"({old / new:.1f}x) "
+            + ("same meals" if same else "MEALS DIFFER")
+        )
+        differ = differ or not same
+    sys.exit(1 if differ else 0)
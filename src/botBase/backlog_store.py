@@ -0,0 +1,177 @@
+import asyncio
+import json
+import logging
+import os
+import pickle
+from collections import Counter, deque
+from time import monotonic
+
+
+FLUSH_THRESHOLD = 200  # journal entries after which a flush is due
+
+
+class BacklogStore:
+    """
+    Write-behind persistence for the message backlogs of all chats. Every change
+    is appended to a journal right away, while the full snapshot is only
+    rewritten by flush. Loading replays the journal on top of the snapshot.
+    Backlogs are deques whose maxlen is the capacity of the chat.
+    """
+
+    def __init__(self, snapshot_path, capacity, threshold=FLUSH_THRESHOLD):
+        self.snapshot_path = snapshot_path
+        self.journal_path = snapshot_path + ".journal"
+        self.capacity = capacity  # for chats that didn't choose their own
+        self.threshold = threshold
+        self.seq = 0  # sequence number of the last journal entry
+        self.dirty = set()  # chats changed since the last flush
+        self.pending = 0  # journal entries since the last flush
+        self.stats = Counter()
+        self._journal = None
+        self._flushing = False
+
+    def load(self):
+        snapshot_seq = 0
+        backlog = {}
+        try:
+            with open(self.snapshot_path, "rb") as f:
+                snapshot = pickle.load(f)
+            # snapshots written before the journal existed are just the backlog
+            if "backlog" in snapshot and "seq" in snapshot:
+                snapshot_seq, backlog = snapshot["seq"], snapshot["backlog"]
+            else:
+                backlog = snapshot
+        except (FileNotFoundError, EOFError):
+            pass
+        # older snapshots hold plain lists
+        backlog = {
+            chat: messages
+            if isinstance(messages, deque)
+            else deque(messages, self.capacity)
+            for chat, messages in backlog.items()
+        }
+
+        self.seq = snapshot_seq
+        replayed = 0
+        for path in [self.journal_path + ".old", self.journal_path]:
+            try:
+                with open(path) as f:
+                    for line in f:
+                        try:
+                            seq, op, chat_id, *args = json.loads(line)
+                        except ValueError:
+                            break  # the last line may be cut off by a crash
+                        if seq > snapshot_seq:
+                            self._apply(backlog, op, chat_id, args)
+                            self.seq = max(self.seq, seq)
+                            replayed += 1
+            except FileNotFoundError:
+                pass
+
+        self._journal = open(self.journal_path, "a")
+        logging.info(
+            f"Loaded backlog of {len(backlog)} chats, "
+            + f"replayed {replayed} journal entries"
+        )
+        return backlog
+
+    def _apply(self, backlog, op, chat_id, args):
+        if op == "start":
+            backlog[chat_id] = deque(maxlen=args[0] if args else self.capacity)
+        elif op == "clear":
+            backlog.setdefault(chat_id, deque(maxlen=self.capacity)).clear()
+        elif op == "stop":
+            backlog.pop(chat_id, None)
+        elif op == "append":
+            messages = backlog.setdefault(chat_id, deque(maxlen=self.capacity))
+            messages.append(tuple(args))
+
+    def record(self, op, chat_id, *args):
+        """
+        Journals a change of the backlog. Returns True once a flush is due.
+        """
+        self.seq += 1
+        line = json.dumps([self.seq, op, chat_id, *args]) + "\n"
+        self._journal.write(line)
+        self._journal.flush()
+
+        self.dirty.add(chat_id)
+        self.pending += 1
+        self.stats["journal entries"] += 1
+        self.stats["journal bytes written"] += len(line.encode())
+        return self.pending >= self.threshold
+
+    def _start_flush(self, backlog):
+        snapshot = {
+            "seq": self.seq,
+            "backlog": {
+                chat: deque(messages, messages.maxlen)
+                for chat, messages in backlog.items()
+            },
+        }
+        # the journal so far is covered by the snapshot, later changes go to a new one
+        self._journal.close()
+        old_path = self.journal_path + ".old"
+        if os.path.exists(old_path):
+            # a failed flush left its journal behind, keep it until a snapshot lands
+            with open(old_path, "a") as old, open(self.journal_path) as journal:
+                old.write(journal.read())
+            os.remove(self.journal_path)
+        else:
+            os.replace(self.journal_path, old_path)
+        self._journal = open(self.journal_path, "a")
+        self.dirty.clear()
+        self.pending = 0
+        return snapshot
+
+    def _write_snapshot(self, snapshot):
+        data = pickle.dumps(snapshot)
+        with open(self.snapshot_path + ".tmp", "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self.snapshot_path + ".tmp", self.snapshot_path)
+        os.remove(self.journal_path + ".old")
+        return len(data)
+
+    def _record_flush(self, chats, size, start):
+        duration = monotonic() - start
+        self.stats["flushes"] += 1
+        self.stats["snapshot bytes written"] += size
+        self.stats["last flush ms"] = round(duration * 1000, 1)
+        self.stats["max flush ms"] = max(
+            self.stats["max flush ms"], self.stats["last flush ms"]
+        )
+        logging.info(
+            f"Flushed backlog of {chats} changed chats "
+            + f"({size} bytes) in {duration * 1000:.1f}ms"
+        )
+
+    async def flush(self, backlog):
+        """
+        Rewrites the snapshot in a worker thread if anything changed
+        """
+        if not self.dirty or self._flushing:
+            return
+        self._flushing = True
+        try:
+            start = monotonic()
+            chats = len(self.dirty)
+            size = await asyncio.to_thread(
+                self._write_snapshot, self._start_flush(backlog)
+            )
+            self._record_flush(chats, size, start)
+        finally:
+            self._flushing = False
+
+    def close(self, backlog):
+        """
+        Flushes synchronously, for when the event loop is already gone
+        """
+        if self.dirty and not self._flushing:
+            start = monotonic()
+            chats = len(self.dirty)
+            self._record_flush(
+                chats, self._write_snapshot(self._start_flush(backlog)), start
+            )
+        self._journal.close()
@@ -0,0 +1,99 @@
+import asyncio
+import logging
+from time import monotonic
+
+from telegram.error import RetryAfter
+
+
+GLOBAL_RATE = 25  # messages per second, Telegram allows about 30 over all chats
+CHAT_INTERVAL = 1.0  # seconds between two messages to the same chat
+MAX_RETRIES = 3
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = monotonic()
+        self._tokens = min(
+            self.capacity, self._tokens + (now - self._updated) * self.rate
+        )
+        self._updated = now
+
+    async def acquire(self):
+        async with self._lock:
+            self._refill()
+            while self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+                self._refill()
+            self._tokens -= 1
+
+    def pause(self, seconds):
+        """
+        Holds back every sender for the given time, e.g. after a 429. Pauses
+        don't add up, concurrent 429s all ask for the same wait.
+        """
+        self._refill()
+        self._tokens = min(self._tokens, -seconds * self.rate)
+
+
+class Broadcaster:
+    """
+    Sends messages to many chats while respecting Telegram's global and
+    per-chat rate limits
+    """
+
+    def __init__(self, bot, rate=GLOBAL_RATE, chat_interval=CHAT_INTERVAL):
+        self.bot = bot
+        self.bucket = TokenBucket(rate)
+        self.chat_interval = chat_interval
+        self._last_sent = {}  # chat id -> monotonic time of the last message
+
+    async def _wait_for_chat(self, chat_id):
+        wait = self._last_sent.get(chat_id, 0) + self.chat_interval - monotonic()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    async def send(self, chat_id, text, **kwargs):
+        for attempt in range(MAX_RETRIES + 1):
+            await self._wait_for_chat(chat_id)
+            await self.bucket.acquire()
+            try:
+                await self.bot.send_message(chat_id=chat_id, text=text, **kwargs)
+                self._last_sent[chat_id] = monotonic()
+                return True
+            except RetryAfter as e:
+                logging.warning(
+                    f"Hit flood limit sending to {chat_id}, "
+                    + f"retrying in {e.retry_after}s (attempt {attempt + 1})"
+                )
+                self.bucket.pause(e.retry_after)
+            except Exception as e:
+                logging.error(
+                    f"Error while broadcasting to {chat_id}: {e.__class__.__name__} {e}"
+                )
+                return False
+        return False
+
+    async def broadcast(self, messages, **kwargs):
+        """
+        Sends every (chat_id, text) pair and returns the number of delivered messages
+        """
+        messages = list(messages)
+        start = monotonic()
+        results = await asyncio.gather(
+            *[self.send(chat_id, text, **kwargs) for chat_id, text in messages]
+        )
+        duration = monotonic() - start
+
+        sent = sum(results)
+        logging.info(
+            f"Broadcast {sent} of {len(messages)} messages in {duration:.2f}s "
+            + f"({sent / duration if duration else sent:.1f} messages/s)"
+        )
+        return sent
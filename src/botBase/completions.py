@@ -0,0 +1,208 @@
+import asyncio
+import hashlib
+import json
+import logging
+import random
+from collections import Counter, OrderedDict
+from contextlib import asynccontextmanager
+from time import monotonic
+
+import openai
+
+
+MAX_CONCURRENT = 4  # completions running at the same time
+REQUEST_TIMEOUT = 60  # seconds
+MAX_RETRIES = 4
+BACKOFF_BASE = 1.0  # seconds, doubled on every retry
+BACKOFF_CAP = 30.0
+CACHE_TTL = 300  # seconds a response is reused for
+CACHE_SIZE = 128
+
+
+class CompletionPool:
+    """
+    Runs chat completions on OpenAI's async API with at most max_concurrent
+    requests in flight. Rate limited requests are retried with full jitter
+    backoff, other errors are raised to the caller.
+    """
+
+    def __init__(
+        self,
+        max_concurrent=MAX_CONCURRENT,
+        timeout=REQUEST_TIMEOUT,
+        max_retries=MAX_RETRIES,
+    ):
+        self.max_concurrent = max_concurrent
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+        self.waiting = 0  # requests queued for a free slot
+        self.active = 0
+        self.stats = Counter()
+        self._latency_total = 0.0
+
+    def backoff(self, attempt):
+        return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2**attempt))
+
+    async def _create(self, **kwargs):
+        for attempt in range(self.max_retries + 1):
+            try:
+                return await openai.ChatCompletion.acreate(
+                    request_timeout=self.timeout, **kwargs
+                )
+            except openai.error.RateLimitError:
+                self.stats["rate limited"] += 1
+                if attempt == self.max_retries:
+                    raise
+                delay = self.backoff(attempt)
+                logging.warning(
+                    f"Rate limited by OpenAI, retrying in {delay:.1f}s "
+                    + f"(attempt {attempt + 1})"
+                )
+                self.stats["retries"] += 1
+                await asyncio.sleep(delay)
+
+    @asynccontextmanager
+    async def _slot(self):
+        """
+        Waits for a free slot and yields the time the request was queued at
+        """
+        queued = monotonic()
+        self.waiting += 1
+        self.stats["max waiting"] = max(self.stats["max waiting"], self.waiting)
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+
+        self.active += 1
+        try:
+            yield queued
+        except Exception as e:
+            self.stats["failures"] += 1
+            logging.error(f"Completion failed: {e.__class__.__name__} {e}")
+            raise
+        finally:
+            self.active -= 1
+            self._semaphore.release()
+
+    async def complete(self, **kwargs):
+        """
+        Returns the response of openai.ChatCompletion for the given arguments
+        """
+        async with self._slot() as queued:
+            start = monotonic()
+            response = await self._create(**kwargs)
+        self._record(queued, start)
+        return response
+
+    async def stream(self, **kwargs):
+        """
+        Streams a chat completion and yields (content, finish_reason) per chunk
+        """
+        async with self._slot() as queued:
+            start = monotonic()
+            first_token = None
+            response = await self._create(stream=True, **kwargs)
+            async for chunk in response:
+                choice = chunk["choices"][0]
+                content = choice["delta"].get("content", "")
+                if first_token is None and content:
+                    first_token = monotonic()
+                    self.stats["last first token ms"] = round(
+                        (first_token - start) * 1000
+                    )
+                yield content, choice.get("finish_reason")
+        self._record(queued, start)
+        logging.info(
+            f"Streamed completion with first token after "
+            + f"{self.stats['last first token ms'] if first_token else '-'}ms "
+            + f"and {self.stats['last latency ms']}ms in total"
+        )
+
+    def _record(self, queued, start):
+        now = monotonic()
+        self.stats["requests"] += 1
+        self._latency_total += now - start
+        self.stats["last wait ms"] = round((start - queued) * 1000)
+        self.stats["last latency ms"] = round((now - start) * 1000)
+
+    def stats_snapshot(self):
+        requests = self.stats["requests"]
+        return {
+            "waiting": self.waiting,
+            "active": self.active,
+            "average latency ms": round(self._latency_total / requests * 1000)
+            if requests
+            else 0,
+            **self.stats,
+        }
+
+
+class ResponseCache:
+    """
+    Caches completions by (model, messages) for ttl seconds, evicting the least
+    recently used one beyond max_entries. Identical requests made while one is
+    running wait for its result instead of starting their own.
+    """
+
+    def __init__(self, ttl=CACHE_TTL, max_entries=CACHE_SIZE):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # key -> (expires at, response)
+        self._inflight = {}  # key -> future of the running request
+        self.stats = Counter()
+
+    @staticmethod
+    def key(model, messages):
+        encoded = json.dumps([model, messages], sort_keys=True).encode()
+        return hashlib.sha256(encoded).hexdigest()
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] < monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    def put(self, key, response):
+        self._entries[key] = (monotonic() + self.ttl, response)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def get_or_run(self, key, run):
+        """
+        Returns the cached response for key or the result of awaiting run()
+        """
+        response = self.get(key)
+        if response is not None:
+            self.stats["hits"] += 1
+            return response
+        if key in self._inflight:
+            self.stats["coalesced"] += 1
+            return await asyncio.shield(self._inflight[key])
+
+        self.stats["misses"] += 1
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            response = await run()
+        except BaseException as e:
+            if isinstance(e, Exception):
+                future.set_exception(e)
+                future.exception()  # nobody might be waiting for it
+            else:
+                future.cancel()
+            raise
+        finally:
+            del self._inflight[key]
+        self.put(key, response)
+        future.set_result(response)
+        return response
+
+    def stats_snapshot(self):
+        return {"entries": len(self._entries), **self.stats}
@@ -0,0 +1,119 @@
+import logging
+from collections import deque
+from itertools import islice
+
+
+TOKENIZER_NAME = "gpt2"  # close enough to OpenAI's tokenizers for budgeting
+CONTEXT_BUDGET = 3000  # prompt tokens for the chat, the rest is left for the answer
+CHARS_PER_TOKEN = 4  # estimate if no tokenizer can be loaded
+
+
+def format_message(name, message):
+    return f"{name}: {message}"
+
+
+class ContextBuilder:
+    """
+    Keeps the token count of every backlog message, counted once when it is
+    logged, and packs the newest messages that fit into a token budget.
+    The counts of a chat are a deque parallel to its backlog. Until
+    load_tokenizer has run, tokens are estimated from the length of the text.
+    """
+
+    def __init__(self, tokenizer_name=TOKENIZER_NAME, budget=CONTEXT_BUDGET):
+        self.tokenizer_name = tokenizer_name
+        self.budget = budget
+        self._tokenizer = None
+        self._counts = {}  # chat id -> deque of token counts
+        self._totals = {}  # chat id -> sum of the counts
+
+    def load_tokenizer(self):
+        """
+        Loads, and the first time downloads, the tokenizer. This blocks, so
+        run it in a worker thread.
+        """
+        try:
+            from transformers import AutoTokenizer
+
+            self._tokenizer = AutoTokenizer.from_pretrained(self.tokenizer_name)
+        except (ImportError, OSError) as e:
+            logging.warning(
+                f"Couldn't load tokenizer {self.tokenizer_name}, "
+                + f"estimating tokens instead: {e}"
+            )
+            self._tokenizer = False
+
+    def count(self, text):
+        if self._tokenizer is None or self._tokenizer is False:
+            return len(text) // CHARS_PER_TOKEN + 1
+        # the line break joining the messages is a token as well
+        return len(self._tokenizer.encode(text)) + 1
+
+    def add(self, chat_id, backlog, name, message):
+        """
+        Counts a message that was just appended to backlog
+        """
+        counts = self._counts.get(chat_id)
+        in_sync = counts is not None and (
+            len(counts) == len(backlog) - 1
+            or len(counts) == len(backlog) == backlog.maxlen
+        )
+        if not in_sync:
+            self._rebuild(chat_id, backlog)
+            return
+        if len(counts) == counts.maxlen:
+            self._totals[chat_id] -= counts[0]
+        tokens = self.count(format_message(name, message))
+        counts.append(tokens)
+        self._totals[chat_id] += tokens
+
+    def _rebuild(self, chat_id, backlog):
+        counts = deque(
+            (self.count(format_message(*entry)) for entry in backlog),
+            maxlen=backlog.maxlen,
+        )
+        self._counts[chat_id] = counts
+        self._totals[chat_id] = sum(counts)
+
+    def reset(self, chat_id):
+        self._counts.pop(chat_id, None)
+        self._totals.pop(chat_id, None)
+
+    def total(self, chat_id):
+        return self._totals.get(chat_id, 0)
+
+    def newest_tokens(self, chat_id, n):
+        """
+        Returns the tokens of the n newest messages as counted by the last pack
+        """
+        counts = self._counts.get(chat_id, ())
+        return sum(islice(reversed(counts), n))
+
+    def pack(self, chat_id, backlog, budget=None):
+        """
+        Returns the newest messages of backlog whose tokens fit into budget
+        """
+        budget = self.budget if budget is None else budget
+        counts = self._counts.get(chat_id)
+        if counts is None or len(counts) != len(backlog):
+            self._rebuild(chat_id, backlog)
+            counts = self._counts[chat_id]
+        if self._totals[chat_id] <= budget:
+            return list(backlog)
+
+        used = 0
+        packed = []
+        for entry, tokens in zip(reversed(backlog), reversed(counts)):
+            if used + tokens > budget:
+                break
+            used += tokens
+            packed.append(entry)
+        packed.reverse()
+        return packed
+
+    def stats(self):
+        return {
+            "chats": len(self._counts),
+            "tokens": sum(self._totals.values()),
+            "budget": self.budget,
+        }
@@ -0,0 +1,101 @@
+import asyncio
+import logging
+import os
+import pickle
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+
+class FavoritesStore:
+    """
+    Favorite mensas per chat in SQLite. Every change is written as its own
+    transaction on a single background thread, so writes stay atomic, keep
+    their order and never block the event loop.
+    """
+
+    def __init__(self):
+        self._db = None
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    def open(self, path):
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._db:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS chats (chat_id INTEGER PRIMARY KEY)"
+            )
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS favorites (chat_id INTEGER, mensa TEXT, "
+                "PRIMARY KEY (chat_id, mensa))"
+            )
+
+    def load(self):
+        chats = self._db.execute("SELECT chat_id FROM chats")
+        favorites = {chat_id: set() for (chat_id,) in chats}
+        rows = self._db.execute("SELECT chat_id, mensa FROM favorites")
+        for chat_id, mensa in rows:
+            favorites.setdefault(chat_id, set()).add(mensa)
+        return favorites
+
+    def migrate_pickle(self, path):
+        """
+        Imports the favorites of the old pickle file into an empty database
+        """
+        if not os.path.exists(path):
+            return
+        if self._db.execute("SELECT COUNT(*) FROM chats").fetchone()[0]:
+            return
+
+        try:
+            with open(path, "rb") as f:
+                favorites = pickle.load(f)
+        except (EOFError, pickle.UnpicklingError) as e:
+            logging.error(f"Couldn't migrate favorites from {path}: {e}")
+            return
+
+        self._execute(self._set_statements(favorites))
+        os.replace(path, path + ".migrated")
+        logging.info(f"Migrated favorites of {len(favorites)} chats from {path}")
+
+    def _set_statements(self, favorites):
+        statements = []
+        for chat_id, mensas in favorites.items():
+            statements.append(("INSERT OR IGNORE INTO chats VALUES (?)", (chat_id,)))
+            statements += [
+                ("INSERT OR IGNORE INTO favorites VALUES (?, ?)", (chat_id, mensa))
+                for mensa in mensas
+            ]
+        return statements
+
+    def _execute(self, statements):
+        with self._db:
+            for sql, parameters in statements:
+                self._db.execute(sql, parameters)
+
+    async def _write(self, statements):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._executor, self._execute, statements)
+
+    async def add_chat(self, chat_id):
+        await self._write(self._set_statements({chat_id: []}))
+
+    async def remove_chat(self, chat_id):
+        await self._write(
+            [
+                ("DELETE FROM favorites WHERE chat_id = ?", (chat_id,)),
+                ("DELETE FROM chats WHERE chat_id = ?", (chat_id,)),
+            ]
+        )
+
+    async def add_favorites(self, chat_id, mensas):
+        await self._write(self._set_statements({chat_id: mensas}))
+
+    async def remove_favorites(self, chat_id, mensas):
+        await self._write(
+            [
+                (
+                    "DELETE FROM favorites WHERE chat_id = ? AND mensa = ?",
+                    (chat_id, mensa),
+                )
+                for mensa in mensas
+            ]
+        )
@@ -0,0 +1,174 @@
+import asyncio
+import logging
+from collections import Counter, OrderedDict, namedtuple
+from time import monotonic
+import httpx
+
+
+REQUEST_TIMEOUT = httpx.Timeout(10.0, connect=5.0)
+POOL_LIMITS = httpx.Limits(max_connections=20, max_keepalive_connections=10)
+
+MAX_VALIDATED = 256  # urls whose validators and parsed result are kept
+FAILURE_THRESHOLD = 3  # failures in a row after which a host is given a break
+COOLDOWN = 120  # seconds before a broken host is probed again
+
+_clients = {}  # event loop -> httpx.AsyncClient
+_validated = OrderedDict()  # url -> Validated of the last full download
+_breakers = {}  # host -> CircuitBreaker
+STATS = Counter()
+
+Validated = namedtuple("Validated", ["etag", "last_modified", "size", "result"])
+
+
+class SourceUnavailable(Exception):
+    pass
+
+
+class CircuitBreaker:
+    """
+    Stops requests to a host after repeated failures. Once the cooldown has
+    passed a single probe request is let through, which closes the circuit
+    again if it succeeds.
+    """
+
+    def __init__(self, host, threshold=FAILURE_THRESHOLD, cooldown=COOLDOWN):
+        self.host = host
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def check(self):
+        if self.opened_at is None:
+            return
+        if self.probing or monotonic() - self.opened_at < self.cooldown:
+            STATS["circuit_rejected"] += 1
+            raise SourceUnavailable(f"{self.host} is currently unavailable")
+        self.probing = True
+
+    def record_success(self):
+        if self.opened_at is not None:
+            logging.info(f"Closed circuit for {self.host}")
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        self.probing = False
+        if self.opened_at is not None or self.failures >= self.threshold:
+            if self.opened_at is None:
+                logging.warning(
+                    f"Opened circuit for {self.host} after {self.failures} failures"
+                )
+                STATS["circuit_opened"] += 1
+            self.opened_at = monotonic()
+
+
+def get_breaker(url):
+    host = httpx.URL(url).host
+    breaker = _breakers.get(host)
+    if breaker is None:
+        breaker = _breakers[host] = CircuitBreaker(host)
+    return breaker
+
+
+def get_client():
+    """
+    Returns the keep-alive client of the running event loop
+    """
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None or client.is_closed:
+        # urlopen, which this replaces, followed redirects as well
+        client = httpx.AsyncClient(
+            timeout=REQUEST_TIMEOUT, limits=POOL_LIMITS, follow_redirects=True
+        )
+        _clients[loop] = client
+    return client
+
+
+async def close_client():
+    client = _clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
+
+
+async def fetch_parsed(url, parse, timeout=None):
+    """
+    Downloads url and returns await parse(chunks) for the decoded body chunks.
+    The request carries the validators of the last download, so a 304 answer
+    reuses the previous result without downloading or parsing anything.
+    """
+    breaker = get_breaker(url)
+    breaker.check()
+    try:
+        result = await _fetch_parsed(url, parse, timeout)
+    except httpx.HTTPStatusError as e:
+        if e.response.status_code >= 500:
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+        raise
+    except httpx.PoolTimeout:
+        # our own pool was full, that says nothing about the host
+        breaker.probing = False
+        raise
+    except httpx.HTTPError:
+        breaker.record_failure()
+        raise
+    except BaseException:
+        # parsing failed or the request was cancelled, a probe is over either way
+        breaker.probing = False
+        raise
+    breaker.record_success()
+    return result
+
+
+async def _fetch_parsed(url, parse, timeout):
+    cached = _validated.get(url)
+    headers = {}
+    if cached is not None and cached.etag:
+        headers["If-None-Match"] = cached.etag
+    if cached is not None and cached.last_modified:
+        headers["If-Modified-Since"] = cached.last_modified
+
+    async with get_client().stream(
+        "GET", url, headers=headers, timeout=timeout or REQUEST_TIMEOUT
+    ) as response:
+        if response.status_code == 304 and cached is not None:
+            STATS["not_modified"] += 1
+            STATS["bytes_saved"] += cached.size
+            _validated.move_to_end(url)
+            return cached.result
+
+        response.raise_for_status()
+        result = await parse(response.aiter_text())
+        size = response.num_bytes_downloaded
+
+    STATS["downloads"] += 1
+    STATS["bytes_downloaded"] += size
+
+    etag = response.headers.get("ETag")
+    last_modified = response.headers.get("Last-Modified")
+    if etag or last_modified:
+        _validated[url] = Validated(etag, last_modified, size, result)
+        _validated.move_to_end(url)
+        while len(_validated) > MAX_VALIDATED:
+            _validated.popitem(last=False)
+    return result
+
+
+def run_sync(coroutine):
+    """
+    Runs a coroutine from synchronous code on a private event loop
+    """
+
+    async def runner():
+        try:
+            return await coroutine
+        finally:
+            await close_client()
+
+    return asyncio.run(runner())
@@ -1,51 +1,332 @@
+import asyncio
+import bisect
 import datetime
 import json
-import urllib.request
-from bs4 import BeautifulSoup
+import logging
+import unicodedata
+from time import monotonic
+from collections import OrderedDict
+from dataclasses import dataclass
+from functools import partial
+
+from botBase import http_client, uni_parser
+from botBase.menu_search import MenuIndex
+from botBase.menu_store import MenuStore
 
 
 MEALTIME_SWITCH = 14  # 14:00
+MEALTIMES = ["lunch", "dinner"]
+ETH_API_URL = "https://www.webservices.ethz.ch/gastro/v1/RVRI/Q1E1/meals/en/{}/{}"
+UNI_MENU_URL = "https://www.mensa.uzh.ch/de/menueplaene/{}/{}.html"
+ETH_CACHE_TTL = datetime.timedelta(minutes=30)
+UMLAUTS = {"ä": "ae", "ö": "oe", "ü": "ue"}
+MENSA_TIMEOUT = 8  # seconds a single mensa may take when fetching several at once
+MAX_RENDERED = 256  # rendered menus kept in the cache
+# pages downloaded at once by fetch_uzh_week, more would just wait for the pool
+UZH_WEEK_CONCURRENCY = http_client.POOL_LIMITS.max_connections // 2
+
+# (date, mealtime) -> (fetched_at, {api_name: Menu})
+_eth_cache = {}
+_eth_inflight = {}  # (date, mealtime) -> asyncio.Task of the running download
+_refreshing = {}  # (mensa, date, mealtime) -> asyncio.Task refreshing a stale menu
+_rendered = OrderedDict()  # (mensa, date, mealtime, menu) -> html
 
 
 def get_meals(name):
     return get_mensa(name).get_meals()
 
 
-def get_mensa(name):
+async def get_meals_async(name):
+    return await get_mensa(name).get_meals_async()
+
+
+async def gather_menus(mensas, timeout=MENSA_TIMEOUT):
+    """
+    Fetches the menus of all given mensas concurrently. The result keeps the
+    order of mensas and holds None for every mensa that failed or timed out.
+    """
+
+    async def fetch(mensa):
+        try:
+            return await asyncio.wait_for(mensa.get_menu_async(), timeout)
+        except Exception as e:
+            logging.warning(f"{mensa.name}: {e.__class__.__name__} {e}")
+            return None
+
+    return await asyncio.gather(*[fetch(mensa) for mensa in mensas])
+
+
+async def fetch_uzh_week(today=None):
+    """
+    Fetches the pages of all UZH mensas for the remaining weekdays of the week in
+    one concurrent pass and puts them into the menu store. Every page is only
+    downloaded once, even if it serves several mealtimes. Returns a dict of
+    url -> seconds the page took, or None for pages that failed.
+    """
+    today = today or datetime.date.today()
+    dates = [
+        (today + datetime.timedelta(days=i)).isoformat()
+        for i in range(7 - today.weekday())
+        if (today + datetime.timedelta(days=i)).weekday() < 5
+    ]
+
+    pages = {}  # url -> [(mensa, date, mealtime)]
     for mensa in available:
-        if mensa.has_alias(name):
-            return mensa
+        if not isinstance(mensa, UniMensa):
+            continue
+        for date in dates:
+            for mealtime in MEALTIMES:
+                url = mensa.source_url(date, mealtime)
+                pages.setdefault(url, []).append((mensa, date, mealtime))
+
+    latencies = {}
+    # leaves connections for menus requested while the pass is running
+    semaphore = asyncio.Semaphore(UZH_WEEK_CONCURRENCY)
+
+    async def fetch(url, slots):
+        mensa, date, mealtime = slots[0]
+        try:
+            async with semaphore:
+                start = monotonic()
+                menu = await mensa.fetch_menu(date, mealtime)
+        except Exception as e:
+            logging.warning(f"{url}: {e.__class__.__name__} {e}")
+            latencies[url] = None
+            return
+        latencies[url] = monotonic() - start
+        for mensa, date, mealtime in slots:
+            menu_store.put(mensa.key, date, mealtime, menu)
+
+    await asyncio.gather(*[fetch(url, slots) for url, slots in pages.items()])
+    return latencies
+
+
+def normalize_alias(alias):
+    alias = alias.casefold()
+    for umlaut, replacement in UMLAUTS.items():
+        alias = alias.replace(umlaut, replacement)
+    alias = unicodedata.normalize("NFKD", alias)
+    alias = "".join(c for c in alias if not unicodedata.combining(c))
+    return " ".join(alias.split())
+
+
+def get_mensa(name):
+    return MENSA_INDEX.get(normalize_alias(name))
+
+
+def match_mensas(prefix):
+    """
+    Returns all mensas with an alias starting with prefix, in the order of available
+    """
+    prefix = normalize_alias(prefix)
+    start = bisect.bisect_left(SORTED_ALIASES, prefix)
+    matches = set()
+    for alias in SORTED_ALIASES[start:]:
+        if not alias.startswith(prefix):
+            break
+        matches.add(MENSA_INDEX[alias])
+    return [mensa for mensa in available if mensa in matches]
+
+
+def parse_mensas(words):
+    """
+    Splits a list of words into mensas, preferring the longest matching alias.
+    Returns the mensas and the words that didn't match any mensa.
+    """
+    mensas = []
+    unknown = []
+    i = 0
+    while i < len(words):
+        for j in range(min(len(words), i + MAX_ALIAS_WORDS), i, -1):
+            mensa = get_mensa(" ".join(words[i:j]))
+            if mensa is not None:
+                mensas.append(mensa)
+                i = j
+                break
+        else:
+            unknown.append(words[i])
+            i += 1
+    return mensas, unknown
+
+
+def build_mensa_index(mensas):
+    # the keys go first so that they always point to their own mensa
+    index = {normalize_alias(mensa.key): mensa for mensa in mensas}
+    for mensa in mensas:
+        for alias in mensa.aliases + [mensa.name]:
+            index.setdefault(normalize_alias(alias), mensa)
+    return index
 
 
 def meal_format(meal):
-    ret = (
-        f"{meal.label} "
-        + f"<i>({meal.price_student}, "
-        + f"{meal.price_staff}, "
-        + f"{meal.price_extern})</i>\n"
+    prices = f"<i>({meal.price_student}, {meal.price_staff}, {meal.price_extern})</i>"
+    if len(meal.description) == 0:
+        return f"{meal.label} {prices}\n"
+    return (
+        f"{meal.label} {prices}\n"
+        + f"<b>{meal.description[0]}</b>\n{' '.join(meal.description[1:])}"
     )
-    if len(meal.description) > 0:
-        ret += f"<b>{meal.description[0]}</b>\n{' '.join(meal.description[1:])}"
-    return ret
 
 
 def mensa_format(mensa, meals):
+    """
+    Formats meals of the current mealtime with the opening hours stored for it
+    """
+    stored = menu_store.peek(mensa.key, *current_mealtime())
+    if stored is None:
+        return menu_format(mensa, Menu(meals))
+    return menu_format(mensa, Menu(meals, stored.opening, stored.closing))
+
+
+def menu_format(mensa, menu):
     times = (
-        f" <i>{mensa.opening}-{mensa.closing}</i>"
+        f" <i>{menu.opening}-{menu.closing}</i>"
         if isinstance(mensa, ETHMensa)
         else ""
     )
     return f"<b>{mensa.name}</b>{times}\n\n" + "\n\n".join(
-        [meal_format(m) for m in meals]
+        [meal_format(m) for m in menu.meals]
     )
 
 
+def render_menu(mensa, menu):
+    """
+    Same as menu_format, but reuses the html as long as the menu doesn't change
+    """
+    key = (mensa.key, *current_mealtime(), menu)
+    rendered = _rendered.get(key)
+    if rendered is None:
+        rendered = _rendered[key] = menu_format(mensa, menu)
+        while len(_rendered) > MAX_RENDERED:
+            _rendered.popitem(last=False)
+    else:
+        _rendered.move_to_end(key)
+    return rendered
+
+
+def current_mealtime(now=None):
+    now = now or datetime.datetime.now()
+    mealtime = "lunch" if now.hour < MEALTIME_SWITCH else "dinner"
+    return now.strftime("%Y-%m-%d"), mealtime
+
+
+def _refresh_done(key, task):
+    del _refreshing[key]
+    if not task.cancelled() and task.exception() is not None:
+        logging.warning(f"Refreshing {key} failed: {task.exception()}")
+
+
+def resolve_source(mensa, now=None):
+    """
+    Returns the (date, mealtime, url) a mensa's menu comes from at the given time
+    """
+    date, mealtime = current_mealtime(now)
+    return date, mealtime, mensa.source_url(date, mealtime)
+
+
+def _eth_hours(mensa):
+    # closed mensas come without a mealtime
+    mealtimes = (mensa.get("hours") or {}).get("mealtime") or [{}]
+    return mealtimes[0].get("from", ""), mealtimes[0].get("to", "")
+
+
+def _parse_eth_payload(mensas):
+    """
+    Returns a Menu per api_name. Every mensa is parsed on its own, so one
+    malformed entry only loses that mensa and not the whole payload.
+    """
+    index = {}
+    for mensa in mensas:
+        try:
+            meals = [
+                Meal(
+                    label=meal["label"],
+                    price_student=meal["prices"]["student"],
+                    price_staff=meal["prices"]["staff"],
+                    price_extern=meal["prices"]["extern"],
+                    description=tuple(meal["description"]),
+                )
+                for meal in mensa["meals"]
+            ]
+            index[mensa["mensa"]] = Menu(meals, *_eth_hours(mensa))
+        except (KeyError, IndexError, TypeError) as e:
+            logging.warning(
+                f"Skipping ETH mensa {mensa.get('mensa')}: {e.__class__.__name__} {e}"
+            )
+    return index
+
+
+async def _parse_eth_chunks(chunks):
+    return _parse_eth_payload(json.loads("".join([chunk async for chunk in chunks])))
+
+
+async def _refresh_eth_index(key):
+    try:
+        index = await http_client.fetch_parsed(
+            ETH_API_URL.format(*key), _parse_eth_chunks
+        )
+        # everything from an earlier mealtime is stale once we switched
+        for old_key in [k for k in _eth_cache if k != key]:
+            del _eth_cache[old_key]
+        _eth_cache[key] = (datetime.datetime.now(), index)
+        # the payload holds every ETH mensa, store them all so search sees them
+        for mensa in available:
+            if isinstance(mensa, ETHMensa):
+                menu_store.put(mensa.key, *key, index.get(mensa.api_name, Menu()))
+        return index
+    finally:
+        _eth_inflight.pop(key, None)
+
+
+async def get_eth_index(date, mealtime):
+    """
+    Returns the parsed ETH gastro payload for (date, mealtime), indexed by api_name.
+    The payload is shared by all ETH mensas, so it is downloaded once per TTL and
+    concurrent callers wait for the download that is already running.
+    """
+    key = (date, mealtime)
+    cached = _eth_cache.get(key)
+    if cached and datetime.datetime.now() - cached[0] < ETH_CACHE_TTL:
+        return cached[1]
+
+    task = _eth_inflight.get(key)
+    if task is None or task.get_loop() is not asyncio.get_running_loop():
+        task = _eth_inflight[key] = asyncio.ensure_future(_refresh_eth_index(key))
+    # shielded so that a caller giving up does not cancel the shared download
+    return await asyncio.shield(task)
+
+
+def uni_meals(extractor):
+    return [
+        Meal(label, *prices, description=tuple(description))
+        for label, prices, description in uni_parser.parse_menu_lines(
+            extractor.text.split("\n")
+        )
+    ]
+
+
+async def _parse_uni_chunks(chunks):
+    extractor = uni_parser.MenuBlockExtractor()
+    async for chunk in chunks:
+        # stop reading the page as soon as the menu block is complete
+        if extractor.feed(chunk):
+            break
+    return uni_meals(extractor)
+
+
+def parse_uni_page(raw_data):
+    extractor = uni_parser.MenuBlockExtractor()
+    extractor.feed(raw_data)
+    return uni_meals(extractor)
+
+
+@dataclass(frozen=True, slots=True)
 class Meal:
-    label = "No label"
-    price_student = "Not available."
-    price_staff = "Not available."
-    price_extern = "Not available."
-    description = []
+    label: str = "No label"
+    price_student: str = "Not available."
+    price_staff: str = "Not available."
+    price_extern: str = "Not available."
+    description: tuple = ()
 
     def __str__(self):
         """
@@ -59,6 +340,87 @@ class Meal:
             out = out + "\n\t{}".format(description)
         return out
 
+    def to_dict(self):
+        return {
+            "label": self.label,
+            "price_student": self.price_student,
+            "price_staff": self.price_staff,
+            "price_extern": self.price_extern,
+            "description": list(self.description),
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**{**data, "description": tuple(data["description"])})
+
+
+@dataclass(frozen=True, slots=True)
+class Menu:
+    """
+    The meals of one mensa together with its opening hours
+    """
+
+    meals: tuple = ()
+    opening: str = ""
+    closing: str = ""
+
+    def __post_init__(self):
+        object.__setattr__(self, "meals", tuple(self.meals))
+
+    def __len__(self):
+        return len(self.meals)
+
+
+def encode_menu(menu):
+    return json.dumps(
+        {
+            "opening": menu.opening,
+            "closing": menu.closing,
+            "meals": [meal.to_dict() for meal in menu.meals],
+        }
+    )
+
+
+def decode_menu(text):
+    data = json.loads(text)
+    meals = [Meal.from_dict(meal) for meal in data["meals"]]
+    return Menu(meals, data["opening"], data["closing"])
+
+
+menu_store = MenuStore(encode=encode_menu, decode=decode_menu)
+menu_index = MenuIndex(normalize=normalize_alias)
+_indexed_slot = None  # (date, mealtime) the menu index holds
+
+
+def _index_menu(mensa, date, mealtime, menu):
+    if (date, mealtime) == _indexed_slot:
+        menu_index.update(mensa, menu)
+
+
+menu_store.listeners.append(_index_menu)
+
+
+def search_menus(query):
+    """
+    Returns (mensa, meal) for all stored meals of the current mealtime that
+    match the query. Nothing is fetched, only menus in the store are searched.
+    Mensas that share a page, like both UZH Zentrum entries, show a meal once.
+    """
+    global _indexed_slot
+    slot = current_mealtime()
+    if slot != _indexed_slot:
+        _indexed_slot = slot
+        for mensa in available:
+            menu_index.update(mensa.key, menu_store.peek(mensa.key, *slot))
+    results = []
+    seen = set()
+    for key, meal in menu_index.search(query):
+        mensa = get_mensa(key)
+        if (mensa.name, meal) not in seen:
+            seen.add((mensa.name, meal))
+            results.append((mensa, meal))
+    return results
+
 
 class Mensa:
     name = "Not available."
@@ -68,11 +430,88 @@ class Mensa:
         """
         Returns list of menu objects of meuns that are available
         """
-        return []
+        return http_client.run_sync(self.get_meals_async())
 
-    # Checks if Mensa could be called that name
-    def has_alias(self, alias):
-        return alias.lower() in self.aliases or alias.lower() == self.name.lower()
+    async def get_meals_async(self):
+        """
+        Same as get_meals, but runs on the calling event loop without blocking it
+        """
+        return list((await self.get_menu_async()).meals)
+
+    async def get_menu_async(self, date=None, mealtime=None):
+        """
+        Returns the Menu with the currently available meals.
+        Meals are served from the menu store and only fetched when missing. A stale
+        menu is still served right away and refreshed in the background.
+        """
+        if date is None or mealtime is None:
+            date, mealtime = current_mealtime()
+        menu = menu_store.get(self.key, date, mealtime)
+        if menu is None:
+            stale = menu_store.get(self.key, date, mealtime, allow_stale=True)
+            # an empty menu is still a stored one, closed mensas have those
+            if stale is not None:
+                self.refresh_in_background(date, mealtime)
+                menu = stale
+            else:
+                menu = await self.refresh_menu(date, mealtime)
+        return menu
+
+    def stored_menu(self, date=None, mealtime=None):
+        """
+        Returns the stored menu, or None if there is none, without waiting for the
+        network. Missing and stale menus are refreshed in the background.
+        """
+        if date is None or mealtime is None:
+            date, mealtime = current_mealtime()
+        menu = menu_store.get(self.key, date, mealtime)
+        if menu is None:
+            self.refresh_in_background(date, mealtime)
+            menu = menu_store.peek(self.key, date, mealtime)
+        return menu
+
+    async def refresh_menu(self, date, mealtime):
+        """
+        Fetches the menu into the menu store. If the source can't be reached, the
+        last menu stored for this mealtime is used instead, and SourceUnavailable
+        is raised if there is none.
+        """
+        try:
+            menu = await self.fetch_menu(date, mealtime)
+        except Exception as e:
+            logging.warning(f"{self.name}: {e.__class__.__name__} {e}")
+            menu = menu_store.get(self.key, date, mealtime, allow_stale=True)
+            if menu is None:
+                if isinstance(e, http_client.SourceUnavailable):
+                    raise
+                menu = Menu()
+        else:
+            menu_store.put(self.key, date, mealtime, menu)
+        return menu
+
+    def refresh_in_background(self, date, mealtime):
+        key = (self.key, date, mealtime)
+        if key not in _refreshing:
+            task = asyncio.ensure_future(self.refresh_menu(date, mealtime))
+            _refreshing[key] = task
+            task.add_done_callback(partial(_refresh_done, key))
+
+    async def fetch_menu(self, date, mealtime):
+        """
+        Downloads the Menu of the given date and mealtime
+        """
+        return Menu()
+
+    def source_url(self, date, mealtime):
+        """
+        Returns the url the menu of the given date and mealtime is downloaded from
+        """
+        return None
+
+    # Unique name of the mensa, the same one users pick it by
+    @property
+    def key(self):
+        return self.aliases[0]
 
 
 # ETH Mensa
@@ -80,42 +519,18 @@ class ETHMensa(Mensa):
     api_name = (
         ""  # the name used in the ETH api (has to be defined by the inheriting class)
     )
-    opening = ""
-    closing = ""
 
-    def get_meals(self):
-        menus = []
-        try:
-            date = datetime.datetime.now().strftime("%Y-%m-%d")
-            mealtime = (
-                "lunch" if datetime.datetime.now().hour < MEALTIME_SWITCH else "dinner"
-            )
-            url = "https://www.webservices.ethz.ch/gastro/v1/RVRI/Q1E1/meals/en/{}/{}".format(
-                date, mealtime
-            )
-            with urllib.request.urlopen(url) as request:
-                mensas = json.loads(request.read().decode())
-
-            for mensa in mensas:
-                if mensa["mensa"] == self.api_name:
-                    self.opening = mensa["hours"]["mealtime"][0]["from"]
-                    self.closing = mensa["hours"]["mealtime"][0]["to"]
-                    for meal in mensa["meals"]:
-                        menu = Meal()
-                        menu.label = meal["label"]
-                        menu.price_student = meal["prices"]["student"]
-                        menu.price_staff = meal["prices"]["staff"]
-                        menu.price_extern = meal["prices"]["extern"]
-                        menu.description = meal["description"]
-                        menus.append(menu)
-            return menus
-        except Exception as e:
-            print(e)
-            return menus  # we failed, but let's pretend nothing ever happened
+    async def fetch_menu(self, date, mealtime):
+        index = await get_eth_index(date, mealtime)
+        return index.get(self.api_name, Menu())
+
+    def source_url(self, date, mealtime):
+        return ETH_API_URL.format(date, mealtime)
 
 
 class UniMensa(Mensa):
     api_name = ""  # the name used on the UNI website (has to be defined by the inheriting class)
+    api_names = {}  # mealtime -> api_name, for mensas that change over the day
 
     tage = [
         "montag",
@@ -127,53 +542,13 @@ class UniMensa(Mensa):
         "sonntag",
     ]
 
-    def get_meals(self):
-        day = self.tage[datetime.datetime.today().weekday()]  # current day
-        url = "https://www.mensa.uzh.ch/de/menueplaene/{}/{}.html".format(
-            self.api_name, day
-        )
-
-        try:
-            with urllib.request.urlopen(url) as request:
-                raw_data = request.read().decode("utf8")
-
-            soup = BeautifulSoup(raw_data, "html.parser")
-            menu_holder = soup.find("div", {"class": "NewsListItem--content"})
+    async def fetch_menu(self, date, mealtime):
+        url = self.source_url(date, mealtime)
+        return Menu(await http_client.fetch_parsed(url, _parse_uni_chunks))
 
-            lines = menu_holder.text.split("\n")
-        except Exception as e:
-            print(e)
-            return []
-
-        menus = []
-        i = 0
-        # Loop until there are no menus left
-        while True:
-            try:
-                # find next menu
-                while i < len(lines) and " | " not in lines[i]:
-                    i += 1
-                # check if we found menu or hit end
-                if i < len(lines):
-                    # very ugly html parsing for a very ugly html site :/
-                    menu = Meal()
-                    menu.label = lines[i].split(" | ")[0]
-                    prices = lines[i].split(" | ")[1].split(" / ")
-
-                    menu.price_student = prices[0].replace("CHF", "").replace(" ", "")
-                    menu.price_staff = prices[1].replace("CHF", "").replace(" ", "")
-                    menu.price_extern = prices[2].replace("CHF", "").replace(" ", "")
-
-                    menu.description = lines[i + 1].split("  ")
-                    menus.append(menu)
-                    i += 1
-                # return what we've found when we hit the end
-                else:
-                    return menus
-            except Exception as e:
-                print(e)
-                # If anything bad happens just ignore it. Just like we do in real life.
-                return menus
+    def source_url(self, date, mealtime):
+        day = self.tage[datetime.date.fromisoformat(date).weekday()]
+        return UNI_MENU_URL.format(self.api_names.get(mealtime, self.api_name), day)
 
 
 class Polymensa(ETHMensa):
@@ -286,12 +661,8 @@ class UZHZentrumAllgemein(UniMensa):
     aliases = ["uni"]
     name = "UZH Zentrum"
 
-    def get_meals(self):
-        if datetime.datetime.now().hour < MEALTIME_SWITCH:
-            self.api_name = "zentrum-mensa"
-        else:
-            self.api_name = "zentrum-mercato-abend"
-        return super().get_meals()
+    api_name = "zentrum-mensa"
+    api_names = {"lunch": "zentrum-mensa", "dinner": "zentrum-mercato-abend"}
 
 
 class UZHLichthof(UniMensa):
@@ -368,3 +739,7 @@ available = [
     BotanischerGarten(),
     UZHZentrumAllgemein(),
 ]
+
+MENSA_INDEX = build_mensa_index(available)
+SORTED_ALIASES = sorted(MENSA_INDEX)
+MAX_ALIAS_WORDS = max(len(alias.split()) for alias in MENSA_INDEX)
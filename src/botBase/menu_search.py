@@ -0,0 +1,54 @@
+import re
+
+
+class MenuIndex:
+    """
+    Inverted index from the words in meal labels and descriptions to the meals.
+    Menus are added per mensa and only re-indexed when they change.
+    """
+
+    def __init__(self, normalize):
+        self.normalize = normalize
+        self._menus = {}  # mensa -> Menu
+        self._postings = {}  # token -> {(mensa, meal position)}
+
+    def tokenize(self, text):
+        return re.findall(r"\w+", self.normalize(text))
+
+    def _meal_tokens(self, meal):
+        return set(self.tokenize(" ".join([meal.label, *meal.description])))
+
+    def update(self, mensa, menu):
+        old = self._menus.get(mensa)
+        if old is menu or old == menu:
+            return
+        if old is not None:
+            for position, meal in enumerate(old.meals):
+                for token in self._meal_tokens(meal):
+                    postings = self._postings[token]
+                    postings.discard((mensa, position))
+                    if not postings:
+                        del self._postings[token]
+
+        if menu is None:
+            self._menus.pop(mensa, None)
+            return
+        self._menus[mensa] = menu
+        for position, meal in enumerate(menu.meals):
+            for token in self._meal_tokens(meal):
+                self._postings.setdefault(token, set()).add((mensa, position))
+
+    def search(self, query):
+        """
+        Returns (mensa, meal) for every meal that contains all words of the query
+        """
+        tokens = self.tokenize(query)
+        if not tokens:
+            return []
+        matches = set.intersection(
+            *[self._postings.get(token, set()) for token in tokens]
+        )
+        return [
+            (mensa, self._menus[mensa].meals[position])
+            for mensa, position in sorted(matches)
+        ]
@@ -0,0 +1,132 @@
+import datetime
+import logging
+import sqlite3
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+
+MENU_TTL = datetime.timedelta(hours=2)
+EMPTY_MENU_TTL = datetime.timedelta(minutes=5)  # menus might just not be out yet
+KEEP_DAYS = 1  # days of past menus kept in the database
+
+
+class MenuStore:
+    """
+    Store of fetched menus keyed by (mensa, date, mealtime). Menus are kept in
+    memory and, once a database is opened, written through to SQLite so that
+    they survive restarts. encode and decode convert a menu to and from text.
+    The database is read once by open and only written on a single background
+    thread afterwards, so lookups and puts never wait for the disk.
+    """
+
+    def __init__(
+        self,
+        encode,
+        decode,
+        ttl=MENU_TTL,
+        empty_ttl=EMPTY_MENU_TTL,
+        keep_days=KEEP_DAYS,
+    ):
+        self.encode = encode
+        self.decode = decode
+        self.ttl = ttl
+        self.empty_ttl = empty_ttl
+        self.keep_days = keep_days
+        self._menus = {}  # (mensa, date, mealtime) -> (fetched_at, menu)
+        self._db = None
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._vacuumed_on = None
+        self.stats = Counter()
+        self.listeners = []  # called with (mensa, date, mealtime, menu) on every put
+
+    def __len__(self):
+        return len(self._menus)
+
+    def open(self, path):
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS menus ("
+            "mensa TEXT, date TEXT, mealtime TEXT, fetched_at TEXT, menu TEXT, "
+            "PRIMARY KEY (mensa, date, mealtime))"
+        )
+        self._db.commit()
+        # only the last keep_days days are kept, so everything fits in memory
+        rows = self._db.execute("SELECT * FROM menus")
+        for mensa, date, mealtime, fetched_at, menu in rows:
+            self._menus.setdefault(
+                (mensa, date, mealtime),
+                (datetime.datetime.fromisoformat(fetched_at), self.decode(menu)),
+            )
+        self.vacuum()
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def _write(self, statements):
+        try:
+            for sql, parameters in statements:
+                self._db.execute(sql, parameters)
+                # VACUUM can't run inside the transaction of a previous statement
+                self._db.commit()
+        except sqlite3.Error as e:
+            logging.error(f"Couldn't write menus: {e}")
+
+    def _submit(self, *statements):
+        if self._db is not None:
+            self._executor.submit(self._write, statements)
+
+    def is_fresh(self, fetched_at, menu):
+        ttl = self.ttl if menu else self.empty_ttl
+        return datetime.datetime.now() - fetched_at <= ttl
+
+    def peek(self, mensa, date, mealtime):
+        """
+        Returns the stored menu, stale or not, without counting it as a lookup
+        """
+        entry = self._menus.get((mensa, date, mealtime))
+        return entry[1] if entry is not None else None
+
+    def get(self, mensa, date, mealtime, allow_stale=False):
+        """
+        Returns the stored menu or None if it is missing or stale
+        """
+        entry = self._menus.get((mensa, date, mealtime))
+        if entry is None or not (allow_stale or self.is_fresh(*entry)):
+            self.stats["misses"] += 1
+            return None
+        self.stats["hits"] += 1
+        return entry[1]
+
+    def put(self, mensa, date, mealtime, menu):
+        if self._vacuumed_on != datetime.date.today():
+            self.vacuum()
+
+        fetched_at = datetime.datetime.now()
+        self._menus[(mensa, date, mealtime)] = (fetched_at, menu)
+        for listener in self.listeners:
+            listener(mensa, date, mealtime, menu)
+        self._submit(
+            (
+                "INSERT OR REPLACE INTO menus VALUES (?, ?, ?, ?, ?)",
+                (mensa, date, mealtime, fetched_at.isoformat(), self.encode(menu)),
+            )
+        )
+
+    def vacuum(self):
+        """
+        Drops the menus of days that are more than keep_days in the past
+        """
+        today = datetime.date.today()
+        cutoff = (today - datetime.timedelta(days=self.keep_days)).isoformat()
+        for key in [key for key in self._menus if key[1] < cutoff]:
+            del self._menus[key]
+        self._vacuumed_on = today
+        self._submit(
+            ("DELETE FROM menus WHERE date < ?", (cutoff,)),
+            ("VACUUM", ()),
+        )
@@ -13,6 +13,11 @@ from urllib3.exceptions import HTTPError
 
 DEVELOPER_CHAT_ID = 631157495
 IGNORED_ERRORS = [NetworkError, HTTPError]
+STATS_PROVIDERS = {}  # name -> function returning a dict of counters
+
+
+def register_stats(name: str, provider: callable):  # type: ignore
+    STATS_PROVIDERS[name] = provider
 
 
 def generate_logs(log_fh):
@@ -112,6 +117,29 @@ async def fetch_log(
     )
 
 
+async def send_stats(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if update.effective_chat.id != DEVELOPER_CHAT_ID:  # type: ignore
+        return
+
+    lines = []
+    for name, provider in STATS_PROVIDERS.items():
+        lines.append(f"<b>{html.escape(name)}</b>")
+        lines += [
+            f"{html.escape(str(key))}: {value}" for key, value in provider().items()
+        ]
+
+    await context.bot.send_message(
+        chat_id=update.effective_chat.id,  # type: ignore
+        text="\n".join(lines) if lines else "No stats registered.",
+        parse_mode=ParseMode.HTML,
+    )
+
+    logging.info(
+        f"Sent stats to {update.effective_chat.title} "  # type: ignore
+        f"({update.effective_chat.id})",  # type: ignore
+    )
+
+
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
     if type(context.error) in IGNORED_ERRORS:
         logging.warning(f"Ignoring error or type: {type(context.error).__name__}")
@@ -141,6 +169,7 @@ def start_bot(
     token: str,
     post_init: callable, # type: ignore
     handlers: list,
+    on_shutdown: callable = None, # type: ignore
 ):
     logging.basicConfig(
         format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
@@ -156,7 +185,12 @@ def start_bot(
     application = ApplicationBuilder().token(token).post_init(post_init).build()
 
     application.add_handler(CommandHandler("log", partial(fetch_log, log_file)))
+    application.add_handler(CommandHandler("stats", send_stats))
     application.add_handlers(handlers)
     application.add_error_handler(error_handler)
 
     application.run_polling()
+
+    if on_shutdown is not None:
+        on_shutdown()
+    logging.info(f"Stopped {bot_name} bot")
@@ -0,0 +1,180 @@
+import logging
+import math
+import os
+import pickle
+import re
+from collections import Counter, deque
+from itertools import islice
+
+import numpy as np
+
+
+HISTORY_LIMIT = 5000  # messages per chat kept for retrieval
+K1 = 1.2  # BM25 term frequency saturation
+B = 0.75  # BM25 length normalization
+
+
+def tokenize(text):
+    return re.findall(r"\w+", text.lower())
+
+
+class ChatIndex:
+    """
+    Inverted index over the messages of one chat, ranked with BM25. Messages
+    get increasing ids and the oldest ones are dropped beyond limit, which
+    always removes the front of every posting list.
+    """
+
+    def __init__(self, limit=HISTORY_LIMIT):
+        self.messages = deque()  # (name, message)
+        self.lengths = deque()  # tokens per message
+        self.first_id = 0  # id of messages[0]
+        self.total_length = 0
+        self.limit = limit
+        self._postings = {}  # token -> deque of (id, count in the message)
+
+    def __len__(self):
+        return len(self.messages)
+
+    def add(self, name, message):
+        counts = Counter(tokenize(f"{name} {message}"))
+        doc_id = self.first_id + len(self.messages)
+        self.messages.append((name, message))
+        self.lengths.append(sum(counts.values()))
+        self.total_length += self.lengths[-1]
+        for token, count in counts.items():
+            self._postings.setdefault(token, deque()).append((doc_id, count))
+
+        if len(self.messages) > self.limit:
+            self._drop_oldest()
+
+    def _drop_oldest(self):
+        name, message = self.messages.popleft()
+        self.total_length -= self.lengths.popleft()
+        for token in set(tokenize(f"{name} {message}")):
+            postings = self._postings[token]
+            postings.popleft()
+            if not postings:
+                del self._postings[token]
+        self.first_id += 1
+
+    def search(self, query, k, skip_latest=0):
+        """
+        Returns (id, message) of the k best matches for query, best first,
+        leaving out the skip_latest newest messages
+        """
+        count = len(self.messages) - skip_latest
+        if count <= 0:
+            return []
+
+        lengths = np.fromiter(self.lengths, dtype=np.float32)
+        norms = K1 * (1 - B + B * lengths / (self.total_length / len(lengths) or 1))
+        scores = np.zeros(len(lengths), dtype=np.float32)
+        for token in set(tokenize(query)):
+            postings = self._postings.get(token)
+            if not postings:
+                continue
+            idf = math.log(
+                1 + (len(lengths) - len(postings) + 0.5) / (len(postings) + 0.5)
+            )
+            ids = np.fromiter((i for i, _ in postings), dtype=np.int64)
+            ids -= self.first_id
+            tfs = np.fromiter((tf for _, tf in postings), dtype=np.float32)
+            scores[ids] += idf * tfs * (K1 + 1) / (tfs + norms[ids])
+
+        scores = scores[:count]
+        best = np.flatnonzero(scores)
+        if len(best) > k:
+            best = best[np.argpartition(-scores[best], k - 1)[:k]]
+        best = best[np.argsort(-scores[best], kind="stable")]
+        return [
+            (self.first_id + int(i), self.messages[int(i)]) for i in best.tolist()
+        ]
+
+
+class RetrievalIndex:
+    """
+    Message history per chat for retrieval. It keeps more messages than the
+    backlog and is saved to its own pickle file.
+    """
+
+    def __init__(self, limit=HISTORY_LIMIT):
+        self.limit = limit
+        self._chats = {}  # chat id -> ChatIndex
+        self.changed = False
+
+    def __contains__(self, chat_id):
+        return chat_id in self._chats
+
+    def add(self, chat_id, name, message):
+        self._chats.setdefault(chat_id, ChatIndex(self.limit)).add(name, message)
+        self.changed = True
+
+    def extend(self, chat_id, messages):
+        for name, message in messages:
+            self.add(chat_id, name, message)
+
+    def reset(self, chat_id):
+        if self._chats.pop(chat_id, None) is not None:
+            self.changed = True
+
+    def chats(self):
+        return list(self._chats)
+
+    def catch_up(self, chat_id, backlog):
+        """
+        Adds the messages of backlog that are newer than the history, which is
+        saved less often than the backlog. The history is expected to end with
+        the oldest messages of backlog, the rest of it is new.
+        """
+        index = self._chats.get(chat_id)
+        if index is None:
+            self.extend(chat_id, backlog)
+            return len(backlog)
+
+        messages = list(backlog)
+        for new in range(len(messages) + 1):
+            overlap = len(messages) - new
+            if overlap > len(index.messages):
+                continue
+            tail = islice(index.messages, len(index.messages) - overlap, None)
+            if all(a == tuple(b) for a, b in zip(messages[:overlap], tail)):
+                break
+        self.extend(chat_id, messages[overlap:])
+        return len(messages) - overlap
+
+    def search(self, chat_id, query, k, skip_latest=0):
+        index = self._chats.get(chat_id)
+        if index is None:
+            return []
+        return index.search(query, k, skip_latest)
+
+    def snapshot(self):
+        """
+        Copies the histories so that they can be saved outside the event loop
+        """
+        self.changed = False
+        return {chat: list(index.messages) for chat, index in self._chats.items()}
+
+    @staticmethod
+    def save(path, snapshot):
+        with open(path + ".tmp", "wb") as f:
+            pickle.dump(snapshot, f)
+        os.replace(path + ".tmp", path)
+
+    def load(self, path):
+        try:
+            with open(path, "rb") as f:
+                histories = pickle.load(f)
+        except (FileNotFoundError, EOFError):
+            return
+        for chat_id, messages in histories.items():
+            self.extend(chat_id, messages)
+        self.changed = False
+        logging.info(f"Loaded message history of {len(histories)} chats")
+
+    def stats(self):
+        return {
+            "chats": len(self._chats),
+            "messages": sum(len(index) for index in self._chats.values()),
+        }
@@ -0,0 +1,78 @@
+import asyncio
+from collections import Counter
+
+
+BLOCK_SIZE = 50  # messages summarized together
+
+
+class RollingSummaries:
+    """
+    Splits the history of every chat into blocks of block_size messages,
+    counted from when the chat was started. Once a block is closed it is
+    summarized a single time by summarize_block, an async function taking a
+    list of messages, and the summary is reused until the block has left the
+    backlog. The pending task is stored right away, so concurrent calls wait
+    for the same summary instead of requesting it again.
+    """
+
+    def __init__(self, summarize_block, block_size=BLOCK_SIZE):
+        self.summarize_block = summarize_block
+        self.block_size = block_size
+        self._logged = {}  # chat id -> number of messages logged since the start
+        self._blocks = {}  # chat id -> {index of the first message: summary task}
+        self.stats = Counter()
+
+    def logged(self, chat_id, backlog):
+        """
+        Counts a message that was just appended to backlog
+        """
+        self._logged[chat_id] = self._logged.get(chat_id, len(backlog) - 1) + 1
+
+    def reset(self, chat_id):
+        self._logged.pop(chat_id, None)
+        self._blocks.pop(chat_id, None)
+
+    async def _summary(self, blocks, start, messages):
+        try:
+            summary = await self.summarize_block(messages)
+        except Exception:
+            # the next call asks again instead of getting the error forever
+            blocks.pop(start, None)
+            raise
+        self.stats["blocks summarized"] += 1
+        return summary
+
+    async def split(self, chat_id, backlog):
+        """
+        Returns the summaries of the closed blocks still in backlog, oldest
+        first, and the messages after them
+        """
+        if backlog.maxlen is not None and backlog.maxlen < 2 * self.block_size:
+            return [], list(backlog)
+
+        total = self._logged.setdefault(chat_id, len(backlog))
+        first = total - len(backlog)  # index of the oldest message in backlog
+        closed = total // self.block_size * self.block_size
+        blocks = self._blocks.setdefault(chat_id, {})
+        for start in [start for start in blocks if start + self.block_size <= first]:
+            del blocks[start]
+
+        messages = list(backlog)
+        starts = range(
+            first // self.block_size * self.block_size, closed, self.block_size
+        )
+        missing = [start for start in starts if start not in blocks]
+        self.stats["blocks reused"] += len(starts) - len(missing)
+        for start in missing:
+            blocks[start] = asyncio.ensure_future(
+                self._summary(
+                    blocks,
+                    start,
+                    messages[max(start - first, 0) : start + self.block_size - first],
+                )
+            )
+        # shielded so that a cancelled caller doesn't cancel the shared tasks
+        summaries = await asyncio.gather(
+            *[asyncio.shield(blocks[start]) for start in starts]
+        )
+        return summaries, messages[max(closed - first, 0) :]
@@ -0,0 +1,113 @@
+import asyncio
+import html
+import logging
+from time import monotonic
+
+from telegram.constants import ParseMode
+from telegram.error import BadRequest, RetryAfter
+
+
+MESSAGE_LIMIT = 4096  # characters per Telegram message
+EDIT_INTERVAL = 3.0  # seconds between edits, groups allow about 20 per minute
+
+
+def split_text(text, limit=MESSAGE_LIMIT):
+    """
+    Splits text into parts of at most limit characters, at a line break or
+    space if possible. Only the last part changes while the text grows.
+    """
+    parts = []
+    while len(text) > limit:
+        cut = text.rfind("\n", 0, limit + 1)
+        if cut <= 0:
+            cut = text.rfind(" ", 0, limit + 1)
+        if cut <= 0:
+            parts.append(text[:limit])
+            text = text[limit:]
+        else:
+            parts.append(text[:cut])
+            text = text[cut + 1 :]
+    parts.append(text)
+    return parts
+
+
+class StreamingReply:
+    """
+    Shows a growing text by editing a placeholder message in place. Edits are
+    throttled and text beyond the message limit continues in new messages.
+    header is HTML and shown above the text, which is escaped.
+    """
+
+    def __init__(self, bot, placeholder, header="", interval=EDIT_INTERVAL):
+        self.bot = bot
+        self.chat_id = placeholder.chat_id
+        self.messages = [placeholder]
+        self.shown = [None]  # rendered text of each message
+        self.header = header
+        self.interval = interval
+        self._next_edit = 0.0
+
+    def _render(self, index, part):
+        return (self.header if index == 0 else "") + html.escape(part)
+
+    async def _show(self, index, rendered):
+        if index < len(self.messages):
+            if self.shown[index] == rendered:
+                return
+            try:
+                await self.bot.edit_message_text(
+                    rendered,
+                    chat_id=self.chat_id,
+                    message_id=self.messages[index].message_id,
+                    parse_mode=ParseMode.HTML,
+                )
+            except BadRequest as e:
+                if "not modified" not in str(e):
+                    raise
+            self.shown[index] = rendered
+        else:
+            message = await self.bot.send_message(
+                chat_id=self.chat_id, text=rendered, parse_mode=ParseMode.HTML
+            )
+            self.messages.append(message)
+            self.shown.append(rendered)
+
+    async def _show_text(self, text):
+        limit = MESSAGE_LIMIT - len(self.header)
+        for index, part in enumerate(split_text(text, limit)):
+            await self._show(index, self._render(index, part))
+
+    async def update(self, text):
+        """
+        Shows text unless the last edit was too recent
+        """
+        if not text.strip() or monotonic() < self._next_edit:
+            return
+        try:
+            await self._show_text(text)
+        except RetryAfter as e:
+            logging.warning(f"Hit flood limit editing in {self.chat_id}")
+            self._next_edit = monotonic() + e.retry_after
+            return
+        self._next_edit = monotonic() + self.interval
+
+    async def finish(self, text):
+        """
+        Shows the complete text, waiting out flood limits if needed
+        """
+        while True:
+            try:
+                await self._show_text(text)
+                return
+            except RetryAfter as e:
+                await asyncio.sleep(e.retry_after)
+
+    async def fail(self, text):
+        """
+        Replaces the reply with an error message
+        """
+        for message in self.messages[1:]:
+            await self.bot.delete_message(self.chat_id, message.message_id)
+        del self.messages[1:], self.shown[1:]
+        self.header = ""
+        await self.finish(text)
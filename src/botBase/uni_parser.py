@@ -0,0 +1,92 @@
+from html.parser import HTMLParser
+
+
+MENU_CLASS = "NewsListItem--content"
+MARKER_OVERLAP = 2048  # characters kept between chunks while looking for the menu
+
+
+class MenuBlockParser(HTMLParser):
+    """
+    Collects the text of the first menu block of a UZH menu page
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.depth = 0  # divs open inside the menu block
+        self.done = False
+        self._text = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag != "div" or self.done:
+            return
+        if self.depth:
+            self.depth += 1
+        elif MENU_CLASS in (dict(attrs).get("class") or "").split():
+            self.depth = 1
+
+    def handle_endtag(self, tag):
+        if tag == "div" and self.depth:
+            self.depth -= 1
+            self.done = self.depth == 0
+
+    def handle_data(self, data):
+        if self.depth:
+            self._text.append(data)
+
+    @property
+    def text(self):
+        return "".join(self._text)
+
+
+class MenuBlockExtractor:
+    """
+    Takes a menu page in chunks and only parses it from the menu block on.
+    feed returns True once the block is complete and the rest can be skipped.
+    """
+
+    def __init__(self):
+        self.parser = MenuBlockParser()
+        self._buffer = ""
+        self._found = False
+
+    def feed(self, chunk):
+        if not self._found:
+            self._buffer += chunk
+            marker = self._buffer.find(MENU_CLASS)
+            if marker == -1:
+                self._buffer = self._buffer[-MARKER_OVERLAP:]
+                return False
+            self._found = True
+            chunk = self._buffer[max(self._buffer.rfind("<", 0, marker), 0) :]
+            self._buffer = ""
+
+        self.parser.feed(chunk)
+        return self.parser.done
+
+    @property
+    def text(self):
+        return self.parser.text
+
+
+def parse_menu_lines(lines):
+    """
+    Returns (label, prices, description) for every menu in the text of a menu block
+    """
+    menus = []
+    for i, line in enumerate(lines):
+        # very ugly html parsing for a very ugly html site :/
+        parts = line.split(" | ")
+        if len(parts) < 2:
+            continue
+        prices = parts[1].split(" / ")
+        if len(prices) < 3 or i + 1 >= len(lines):
+            # If anything bad happens just ignore it. Just like we do in real life.
+            break
+        menus.append(
+            (
+                parts[0],
+                [price.replace("CHF", "").replace(" ", "") for price in prices[:3]],
+                lines[i + 1].split("  "),
+            )
+        )
+    return menus
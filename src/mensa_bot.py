@@ -1,18 +1,23 @@
+import asyncio
 import logging
 from datetime import time
+from time import perf_counter
 import pytz
-import pickle
 import numpy as np
 
-from botBase import pi_bot, mensa_helpers, reaction_emojis
+from botBase import pi_bot, mensa_helpers, reaction_emojis, broadcast, http_client
+from botBase.favorites_store import FavoritesStore
 
 from telegram.constants import ParseMode
 from telegram import (
     Update,
+    InlineQueryResultArticle,
+    InputTextMessageContent,
 )
 from telegram.ext import (
     filters,
     MessageHandler,
+    InlineQueryHandler,
     ApplicationBuilder,
     ContextTypes,
     CommandHandler,
@@ -22,34 +27,58 @@ from telegram.ext import (
 
 LOG_FILE = "WitiGrailleBotFiles/bot.log"
 BOT_TOKEN_FILE = "WitiGrailleBotFiles/TOKEN.token"
-FAVORITES_FILE = "WitiGrailleBotFiles/favorite_mensas.pickle"
+FAVORITES_FILE = "WitiGrailleBotFiles/favorite_mensas.sqlite"
+OLD_FAVORITES_FILE = "WitiGrailleBotFiles/favorite_mensas.pickle"
+MENUS_FILE = "WitiGrailleBotFiles/menus.sqlite"
 DEVELOPER_CHAT_ID = 631157495
 ERRORS_TO_LOG = []
 MENSAS = [mensa.aliases[0] for mensa in mensa_helpers.available]
 FAVORITE_MENSAS = {}
+FAVORITES_STORE = FavoritesStore()
+BROADCASTER = None
 FAVORITE_TIME = time(9, 00, tzinfo=pytz.timezone("Europe/Zurich"))
+PREFETCH_TIME = time(8, 50, tzinfo=pytz.timezone("Europe/Zurich"))
+PREFETCH_TIMEOUT = 60
+WEEK_PREFETCH_TIME = time(3, 00, tzinfo=pytz.timezone("Europe/Zurich"))
+INLINE_CACHE_TIME = 300  # seconds Telegram may reuse an inline answer
+MAX_INLINE_RESULTS = 50
+MAX_SEARCH_RESULTS = 30
+MESSAGE_LIMIT = 4096  # characters per Telegram message
+INLINE_RESULTS = {}  # mensa key -> (menu, InlineQueryResultArticle)
 TIMES = ["11:30", "11:45", "12:00", "12:15", "12:30", "12:45", "13:00"]
 
 
-def update_favorite_pickle():
-    global FAVORITE_MENSAS
-    with open(FAVORITES_FILE, "wb") as f:
-        pickle.dump(FAVORITE_MENSAS, f)
+def menu_stats():
+    stats = {f"store {key}": n for key, n in mensa_helpers.menu_store.stats.items()}
+    stats.update({f"http {key}": n for key, n in http_client.STATS.items()})
+    return stats
 
 
-def load_favorite_pickle():
+def load_favorites():
     global FAVORITE_MENSAS
-    try:
-        with open(FAVORITES_FILE, "rb") as f:
-            FAVORITE_MENSAS = pickle.load(f)
-    except (FileNotFoundError, EOFError):
-        pass
+    FAVORITES_STORE.open(FAVORITES_FILE)
+    FAVORITES_STORE.migrate_pickle(OLD_FAVORITES_FILE)
+    FAVORITE_MENSAS = FAVORITES_STORE.load()
 
 
 async def mensa_menu(mensa, update, context):
     mensa = mensa_helpers.get_mensa(mensa)
-    meals = mensa.get_meals()
-    if len(meals) == 0:
+    try:
+        menu = await mensa.get_menu_async()
+    except http_client.SourceUnavailable:
+        await context.bot.send_message(
+            chat_id=update.effective_chat.id,
+            text=f"I can't reach the menu of {mensa.name} right now. "
+            + "Please try again in a few minutes.",
+        )
+        logging.info(
+            f"Menu source of {mensa.name} is unavailable "
+            + f"for {update.effective_chat.title} "
+            + f"with id {update.effective_chat.id}"
+        )
+        return
+
+    if len(menu) == 0:
         await context.bot.send_message(
             chat_id=update.effective_chat.id,
             text="I couldn't find a menu for today. Please try again tomorrow.",
@@ -63,7 +92,7 @@ async def mensa_menu(mensa, update, context):
 
     await context.bot.send_message(
         chat_id=update.effective_chat.id,
-        text=mensa_helpers.mensa_format(mensa, meals),
+        text=mensa_helpers.render_menu(mensa, menu),
         parse_mode=ParseMode.HTML,
     )
 
@@ -73,26 +102,32 @@ async def mensa_menu(mensa, update, context):
     )
 
 
-def format_favorites(chat_id):
+async def format_favorites(favorites):
     message = "Favorite mensas:\n\n"
 
+    mensas = [mensa_helpers.get_mensa(mensa) for mensa in sorted(favorites)]
     mensa_emojis = np.random.permutation(reaction_emojis.REACTION_EMOJIS)[
-        : len(FAVORITE_MENSAS[chat_id])
+        : len(mensas)
     ]
 
-    for emoji, mensa in zip(mensa_emojis, FAVORITE_MENSAS[chat_id]):
-        mensa = mensa_helpers.get_mensa(mensa)
-        meals = mensa.get_meals()
-        if len(meals) == 0:
+    menus = await mensa_helpers.gather_menus(mensas)
+    for emoji, mensa, menu in zip(mensa_emojis, mensas, menus):
+        if menu is None:
+            message += (
+                f"{emoji}<b>{mensa.name}</b>\n<i>Menu currently unavailable.</i>\n\n"
+            )
+            continue
+        if len(menu) == 0:
             continue
 
-        message += f"{emoji}{mensa_helpers.mensa_format(mensa, meals)}\n\n"
+        message += f"{emoji}{mensa_helpers.render_menu(mensa, menu)}\n\n"
 
     return message
 
 
 async def mensa(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if len(context.args) == 0 or context.args[0] not in MENSAS:  # type: ignore
+    name = " ".join(context.args)  # type: ignore
+    if mensa_helpers.get_mensa(name) is None:
         await context.bot.send_message(
             chat_id=update.effective_chat.id,
             text="Please provide a valid mensa name. "
@@ -105,21 +140,135 @@ async def mensa(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
     else:
-        await mensa_menu(context.args[0], update, context)  # type: ignore
+        await mensa_menu(name, update, context)
 
 
-async def post_init(application: Application):
-    global FAVORITE_MENSAS
-    load_favorite_pickle()
-
-    for chat_id in FAVORITE_MENSAS:
-        application.job_queue.run_daily(
-            favorite_job,
-            time=FAVORITE_TIME,
-            days=(1, 2, 3, 4, 5),
-            chat_id=chat_id,
-            name=str(chat_id),
+async def search(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = " ".join(context.args)  # type: ignore
+    if not query:
+        await context.bot.send_message(
+            chat_id=update.effective_chat.id,
+            text="Please tell me what to search for, e.g. /search curry",
+        )
+        return
+
+    results = mensa_helpers.search_menus(query)
+    if not results:
+        await context.bot.send_message(
+            chat_id=update.effective_chat.id,
+            text=f"I couldn't find {query} on any menu I know of today.",
+        )
+        logging.info(
+            f"Found nothing for search {query} "
+            + f"from {update.effective_user.name} "
+            + f"with id {update.effective_user.id}"
         )
+        return
+
+    meals_by_mensa = {}
+    for mensa, meal in results[:MAX_SEARCH_RESULTS]:
+        meals_by_mensa.setdefault(mensa, []).append(meal)
+
+    blocks = [
+        f"<b>{mensa.name}</b>\n"
+        + "\n\n".join(mensa_helpers.meal_format(meal) for meal in meals)
+        for mensa, meals in meals_by_mensa.items()
+    ]
+    if len(results) > MAX_SEARCH_RESULTS:
+        blocks.append(
+            f"<i>...and {len(results) - MAX_SEARCH_RESULTS} more meals, "
+            + "try a more specific search.</i>"
+        )
+
+    # split between mensas so that no message goes over Telegram's limit
+    messages = [""]
+    for block in blocks:
+        if messages[-1] and len(messages[-1]) + len(block) + 2 > MESSAGE_LIMIT:
+            messages.append("")
+        messages[-1] += ("\n\n" if messages[-1] else "") + block
+
+    for text in messages:
+        await context.bot.send_message(
+            chat_id=update.effective_chat.id,
+            text=text,
+            parse_mode=ParseMode.HTML,
+        )
+
+    logging.info(
+        f"Sent {len(results)} results for search {query} "
+        + f"to {update.effective_user.name} "
+        + f"with id {update.effective_user.id}"
+    )
+
+
+def inline_result(mensa, menu):
+    cached = INLINE_RESULTS.get(mensa.key)
+    if cached is not None and cached[0] == menu:
+        return cached[1]
+
+    result = InlineQueryResultArticle(
+        id=mensa.key,
+        title=mensa.name,
+        description=", ".join(meal.label for meal in menu.meals),
+        input_message_content=InputTextMessageContent(
+            mensa_helpers.render_menu(mensa, menu), parse_mode=ParseMode.HTML
+        ),
+    )
+    INLINE_RESULTS[mensa.key] = (menu, result)
+    return result
+
+
+async def inline_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    mensas = mensa_helpers.match_mensas(update.inline_query.query)
+    results = []
+    shown = set()  # mensas sharing a page would show the same article twice
+    complete = True
+    for mensa in mensas[:MAX_INLINE_RESULTS]:
+        menu = mensa.stored_menu()
+        if menu is None:
+            complete = False
+        elif len(menu) > 0 and (mensa.name, menu) not in shown:
+            shown.add((mensa.name, menu))
+            results.append(inline_result(mensa, menu))
+
+    # let telegram cache the answer only once every menu was there
+    await update.inline_query.answer(
+        results, cache_time=INLINE_CACHE_TIME if complete else 10
+    )
+
+    logging.info(
+        f"Answered inline query {update.inline_query.query} "
+        + f"from {update.effective_user.name} "
+        + f"with id {update.effective_user.id} "
+        + f"with {len(results)} menus"
+    )
+
+
+async def post_init(application: Application):
+    global FAVORITE_MENSAS, BROADCASTER
+    load_favorites()
+    mensa_helpers.menu_store.open(MENUS_FILE)
+    BROADCASTER = broadcast.Broadcaster(application.bot)
+
+    application.job_queue.run_daily(
+        prefetch_job,
+        time=PREFETCH_TIME,
+        days=(1, 2, 3, 4, 5),
+        name="prefetch",
+    )
+    application.job_queue.run_daily(
+        week_prefetch_job,
+        time=WEEK_PREFETCH_TIME,
+        days=(1, 2, 3, 4, 5),
+        name="week_prefetch",
+    )
+
+    application.job_queue.run_daily(
+        favorite_job,
+        time=FAVORITE_TIME,
+        days=(1, 2, 3, 4, 5),
+        name="favorites",
+    )
 
     await application.bot.send_message(
         chat_id=DEVELOPER_CHAT_ID,
@@ -133,8 +282,8 @@ async def post_init(application: Application):
 
 async def generic_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     command = update.effective_message.text[1:].split("@")[0]
-    if command in MENSAS:  # type: ignore
-        await mensa_helpers.mensa_menu(command, update, context)
+    if mensa_helpers.get_mensa(command) is not None:
+        await mensa_menu(command, update, context)
         return
 
     logging.info(
@@ -173,7 +322,7 @@ async def mensa_favorites(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     await context.bot.send_message(
         chat_id=chat_id,
-        text=format_favorites(chat_id),
+        text=await format_favorites(FAVORITE_MENSAS[chat_id]),
         parse_mode=ParseMode.HTML,
     )
     logging.info(
@@ -220,38 +369,79 @@ async def make_poll(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 
-async def favorite_job(context: ContextTypes.DEFAULT_TYPE) -> None:
-    job = context.job
-    message = format_favorites(job.chat_id)
+async def prefetch_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    favorites = sorted(set().union(*FAVORITE_MENSAS.values()))
+    mensas = [mensa_helpers.get_mensa(mensa) for mensa in favorites]
 
-    await context.bot.send_message(
-        chat_id=job.chat_id, text=message, parse_mode=ParseMode.HTML
+    start = perf_counter()
+    menus = await mensa_helpers.gather_menus(mensas, timeout=PREFETCH_TIMEOUT)
+    duration = perf_counter() - start
+
+    prefetched = sum(1 for menu in menus if menu is not None)
+    logging.info(
+        f"Prefetched {prefetched} of {len(mensas)} favorite mensas "
+        + f"({sum(len(menu or []) for menu in menus)} meals) "
+        + f"in {duration:.2f}s"
     )
 
-    logging.info(f"Sent favorite mensas to chat with id {job.chat_id}")
+
+async def week_prefetch_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    start = perf_counter()
+    latencies = await mensa_helpers.fetch_uzh_week()
+    duration = perf_counter() - start
+
+    fetched = {
+        url: seconds for url, seconds in latencies.items() if seconds is not None
+    }
+    logging.info(
+        f"Fetched {len(fetched)} of {len(latencies)} UZH menu pages "
+        + f"for the week in {duration:.2f}s:\n"
+        + "\n".join(
+            f"{latency:.2f}s {url}"
+            for url, latency in sorted(fetched.items(), key=lambda page: -page[1])
+        )
+    )
+
+
+async def favorite_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    # chats with the same favorites get the same message, render it only once
+    chats_by_favorites = {}
+    for chat_id, favorites in FAVORITE_MENSAS.items():
+        if favorites:
+            chats_by_favorites.setdefault(frozenset(favorites), []).append(chat_id)
+
+    favorite_sets = list(chats_by_favorites)
+    formatted = await asyncio.gather(
+        *[format_favorites(favorites) for favorites in favorite_sets]
+    )
+
+    messages = [
+        (chat_id, message)
+        for favorites, message in zip(favorite_sets, formatted)
+        for chat_id in chats_by_favorites[favorites]
+    ]
+    await BROADCASTER.broadcast(messages, parse_mode=ParseMode.HTML)
+
+    logging.info(
+        f"Sent favorite mensas to {len(messages)} chats "
+        + f"with {len(favorite_sets)} distinct favorite sets"
+    )
 
 
 async def set_daily_mensa(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     chat_id = update.effective_message.chat_id
-    if context.job_queue.get_jobs_by_name(str(chat_id)):
+    if chat_id in FAVORITE_MENSAS:
         await update.effective_message.reply_text(
             "You already have an active daily mensa job!"
         )
         return
 
     FAVORITE_MENSAS[chat_id] = set()
-    context.job_queue.run_daily(
-        favorite_job,
-        time=FAVORITE_TIME,
-        days=(1, 2, 3, 4, 5),
-        chat_id=chat_id,
-        name=str(chat_id),
-    )
     await update.effective_message.reply_text(
         "Successfully set daily mensa job for favorite mensas!"
     )
 
-    update_favorite_pickle()
+    await FAVORITES_STORE.add_chat(chat_id)
 
     logging.info(
         f"Set daily mensa job for {update.effective_chat.title} "
@@ -261,16 +451,13 @@ async def set_daily_mensa(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
 async def unset_daily_mensa(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     chat_id = update.message.chat_id
-    current_jobs = context.job_queue.get_jobs_by_name(str(chat_id))
-    if not current_jobs:
+    if chat_id not in FAVORITE_MENSAS:
         await update.message.reply_text("You have no active daily mensa job!")
         return
     FAVORITE_MENSAS.pop(chat_id)
-    for job in current_jobs:
-        job.schedule_removal()
     await update.message.reply_text("Successfully unset daily mensa job!")
 
-    update_favorite_pickle()
+    await FAVORITES_STORE.remove_chat(chat_id)
 
     logging.info(
         f"Unset daily mensa job for {update.effective_chat.title} "
@@ -287,17 +474,19 @@ async def add_favorite_mensa(
         )
         return
 
-    success = []
-    for arg in context.args:  # type: ignore
-        if arg not in MENSAS:
-            await update.message.reply_text(
-                f"{arg} is not a valid mensa name. "
-                + f"Valid mensas are: \n{', '.join(MENSAS)}"
-            )
-            continue
+    mensas, unknown = mensa_helpers.parse_mensas(context.args)  # type: ignore
+    for arg in unknown:
+        await update.message.reply_text(
+            f"{arg} is not a valid mensa name. "
+            + f"Valid mensas are: \n{', '.join(MENSAS)}"
+        )
+    if not mensas:
+        return
 
-        FAVORITE_MENSAS[update.effective_message.chat_id].add(arg)  # type: ignore
-        success.append(arg)
+    success = []
+    for mensa in mensas:
+        FAVORITE_MENSAS[update.effective_message.chat_id].add(mensa.key)
+        success.append(mensa.key)
 
     success[-1] = "and " + success[-1]
 
@@ -305,7 +494,9 @@ async def add_favorite_mensa(
         f"Successfully added {', '.join(success)} to favorite mensas!"  # type: ignore
     )
 
-    update_favorite_pickle()
+    await FAVORITES_STORE.add_favorites(
+        update.effective_message.chat_id, [mensa.key for mensa in mensas]
+    )
 
     logging.info(
         f"Added {', '.join(success)} to favorite mensas for {update.effective_chat.title} "  # type: ignore
@@ -322,17 +513,19 @@ async def remove_favorite_mensa(
         )
         return
 
-    success = []
-    for arg in context.args:  # type: ignore
-        if arg not in MENSAS:
-            await update.message.reply_text(
-                f"{arg} is not a valid mensa name. "
-                + f"Valid mensas are: \n{', '.join(MENSAS)}"
-            )
-            continue
+    mensas, unknown = mensa_helpers.parse_mensas(context.args)  # type: ignore
+    for arg in unknown:
+        await update.message.reply_text(
+            f"{arg} is not a valid mensa name. "
+            + f"Valid mensas are: \n{', '.join(MENSAS)}"
+        )
+    if not mensas:
+        return
 
-        FAVORITE_MENSAS[update.effective_message.chat_id].remove(arg)  # type: ignore
-        success.append(arg)
+    success = []
+    for mensa in mensas:
+        FAVORITE_MENSAS[update.effective_message.chat_id].discard(mensa.key)
+        success.append(mensa.key)
 
     success[-1] = "and " + success[-1]
 
@@ -340,7 +533,9 @@ async def remove_favorite_mensa(
         f"Successfully removed {', '.join(success)} from favorite mensas!"  # type: ignore
     )
 
-    update_favorite_pickle()
+    await FAVORITES_STORE.remove_favorites(
+        update.effective_message.chat_id, [mensa.key for mensa in mensas]
+    )
 
     logging.info(
         f"Removed {', '.join(success)} from favorite mensas for {update.effective_chat.title} "  # type: ignore
@@ -361,6 +556,7 @@ if __name__ == "__main__":
         "remove - Remove a mensa from your favorite mensas\n"
         "favorite - Get the menu for your favorite mensas. Only Works if you have a daily mensa job set\n"
         "poll - Create a poll for the menu of a mensa\n"
+        "search - Find a dish on today's menus\n"
     )
 
     commands += "\n".join(
@@ -378,7 +574,10 @@ if __name__ == "__main__":
         CommandHandler("remove", remove_favorite_mensa),
         CommandHandler("favorite", mensa_favorites),
         CommandHandler("poll", make_poll),
+        CommandHandler("search", search),
+        InlineQueryHandler(inline_menu),
         MessageHandler(filters.COMMAND, generic_command),
     ]
 
+    pi_bot.register_stats("menus", menu_stats)
     pi_bot.start_bot("mensa", commands, LOG_FILE, token, post_init, handlers)
@@ -1,14 +1,23 @@
+import asyncio
+import html
 import logging
-import pickle
+from collections import deque
+from functools import partial
+from itertools import islice
 
 from botBase import pi_bot
+from botBase.backlog_store import BacklogStore
+from botBase.completions import CompletionPool, ResponseCache
+from botBase.context_builder import ContextBuilder, format_message
+from botBase.retrieval import RetrievalIndex
+from botBase.rolling_summary import RollingSummaries
+from botBase.streaming import StreamingReply
 
 import openai
 from telegram import (
     Update,
     Message,
 )
-from telegram.constants import ParseMode
 from telegram.ext import (
     filters,
     MessageHandler,
@@ -21,35 +30,91 @@ LOG_FILE = "WitiBotFiles/bot.log"
 BOT_TOKEN_FILE = "WitiBotFiles/TOKEN.token"
 OPENAI_TOKEN_FILE = "WitiBotFiles/OPENAI.token"
 MESSAGES_FILE = "WitiBotFiles/message_backlog.pickle"
+HISTORY_FILE = "WitiBotFiles/message_history.pickle"
 DEVELOPER_CHAT_ID = 631157495
 MESSAGE_BACKLOG = {}
 BACKLOG_LENGTH = 200
 APPROVED_CHATS = [631157495, -1001517711069]
 PRINT_LIMIT = 10
+BACKLOG_STORE = BacklogStore(MESSAGES_FILE, BACKLOG_LENGTH)
+FLUSH_INTERVAL = 60  # seconds between flushes of the backlog snapshot
+COMPLETIONS = CompletionPool()
+RESPONSES = ResponseCache()
+HISTORY = RetrievalIndex()
+HISTORY_SAVE_INTERVAL = 600  # seconds between saves of the retrieval history
+HISTORY_SAVE_LOCK = asyncio.Lock()
+TOP_K = 15  # older messages retrieved for /prompt
+RECENT_MESSAGES = 30  # newest messages always sent with /prompt
+CONTEXT = ContextBuilder()
+BLOCK_SUMMARY_PROMPT = (
+    "Summarize the following part of a chat conversation in English "
+    "in a few sentences. Keep names, decisions and open questions."
+)
 
 
-def update_messages_pickle():
-    global MESSAGE_BACKLOG
-    modified_message_backlog = {
-        user: messages for user, messages in MESSAGE_BACKLOG.items()
-    }
-    with open(MESSAGES_FILE, "wb") as f:
-        pickle.dump(modified_message_backlog, f)
-    logging.info("Updated message backlog")
+async def summarize_block(messages: list):
+    response = await COMPLETIONS.complete(
+        model="gpt-3.5-turbo",
+        messages=[
+            {"role": "system", "content": BLOCK_SUMMARY_PROMPT},
+            {"role": "user", "content": format_backlog(messages)},
+        ],
+    )
+    return response["choices"][0]["message"]["content"]  # type: ignore
 
 
-def load_messages_pickle():
-    global MESSAGE_BACKLOG
-    try:
-        with open(MESSAGES_FILE, "rb") as f:
-            MESSAGE_BACKLOG = pickle.load(f)
-    except (FileNotFoundError, EOFError):
-        pass
-    logging.info("Loaded message backlog")
+SUMMARIES = RollingSummaries(summarize_block)
+
+
+def record_change(context: ContextTypes.DEFAULT_TYPE, op: str, chat_id, *args):
+    if BACKLOG_STORE.record(op, chat_id, *args):
+        context.application.create_task(BACKLOG_STORE.flush(MESSAGE_BACKLOG))
+
+
+async def flush_job(context: ContextTypes.DEFAULT_TYPE):
+    await BACKLOG_STORE.flush(MESSAGE_BACKLOG)
+
+
+async def save_history_job(context: ContextTypes.DEFAULT_TYPE):
+    async with HISTORY_SAVE_LOCK:
+        if HISTORY.changed:
+            await asyncio.to_thread(HISTORY.save, HISTORY_FILE, HISTORY.snapshot())
+            logging.info("Saved message history")
+
+
+def shutdown():
+    BACKLOG_STORE.close(MESSAGE_BACKLOG)
+    HISTORY.save(HISTORY_FILE, HISTORY.snapshot())
+    logging.info("Flushed message backlog")
+
+
+def backlog_stats():
+    return {
+        "chats": len(MESSAGE_BACKLOG),
+        "dirty chats": len(BACKLOG_STORE.dirty),
+        **BACKLOG_STORE.stats,
+    }
 
 
 async def post_init(application: Application) -> None:
-    load_messages_pickle()
+    global MESSAGE_BACKLOG
+    MESSAGE_BACKLOG = BACKLOG_STORE.load()
+    await asyncio.to_thread(CONTEXT.load_tokenizer)
+    HISTORY.load(HISTORY_FILE)
+    # the history is saved less often than the backlog, bring it up to date
+    for chat_id in HISTORY.chats():
+        if chat_id not in MESSAGE_BACKLOG:
+            HISTORY.reset(chat_id)
+    for chat_id, backlog in MESSAGE_BACKLOG.items():
+        added = HISTORY.catch_up(chat_id, backlog)
+        if added:
+            logging.info(f"Added {added} messages of {chat_id} to its history")
+    application.job_queue.run_repeating(
+        flush_job, interval=FLUSH_INTERVAL, name="flush backlog"
+    )
+    application.job_queue.run_repeating(
+        save_history_job, interval=HISTORY_SAVE_INTERVAL, name="save history"
+    )
     await application.bot.send_message(
         chat_id=DEVELOPER_CHAT_ID,
         text="Bot started!",
@@ -74,10 +139,24 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     backlog_length = BACKLOG_LENGTH
     if context.args:
-        backlog_length = int(context.args[0])
+        try:
+            backlog_length = int(context.args[0])
+        except ValueError:
+            backlog_length = 0
+        if backlog_length < 1:
+            await context.bot.send_message(
+                chat_id=update.effective_chat.id,
+                text="The backlog length has to be a positive number.",
+            )
+            return
 
-    MESSAGE_BACKLOG[update.effective_chat.id] = []
-    update_messages_pickle()
+    MESSAGE_BACKLOG[update.effective_chat.id] = deque(maxlen=backlog_length)
+    record_change(context, "start", update.effective_chat.id, backlog_length)
+    CONTEXT.reset(update.effective_chat.id)
+    SUMMARIES.reset(update.effective_chat.id)
+    HISTORY.reset(update.effective_chat.id)
+    # saved right away, a stale history would bring the dropped messages back
+    context.application.create_task(save_history_job(context))
 
     await context.bot.send_message(
         chat_id=update.effective_chat.id,
@@ -95,7 +174,12 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def stop(update: Update, context: ContextTypes.DEFAULT_TYPE):
     MESSAGE_BACKLOG.pop(update.effective_chat.id)
-    update_messages_pickle()
+    record_change(context, "stop", update.effective_chat.id)
+    CONTEXT.reset(update.effective_chat.id)
+    SUMMARIES.reset(update.effective_chat.id)
+    HISTORY.reset(update.effective_chat.id)
+    # saved right away, a stale history would bring the dropped messages back
+    context.application.create_task(save_history_job(context))
 
     await context.bot.send_message(
         chat_id=update.effective_chat.id, text="I will no longer listen to this chat."
@@ -121,7 +205,7 @@ async def show_backlog(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         await context.bot.send_message(
             chat_id=update.effective_chat.id,
-            text=f"Here's what I've seen so far:\n...\n{format_backlog(backlog[-PRINT_LIMIT:])}",
+            text=f"Here's what I've seen so far:\n...\n{format_backlog(latest(backlog, PRINT_LIMIT))}",
         )
 
     logging.info(
@@ -132,16 +216,18 @@ async def show_backlog(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def log(update: Update, context: ContextTypes.DEFAULT_TYPE):
     backlog = MESSAGE_BACKLOG[update.effective_chat.id]
-    while len(backlog) > BACKLOG_LENGTH:
-        del backlog[0]
-
     user = (
         update.effective_message.forward_from.name
         if update.effective_message.forward_from is not None
         else update.effective_user.name
     )
     backlog.append((user, update.effective_message.text))
-    update_messages_pickle()
+    record_change(
+        context, "append", update.effective_chat.id, user, update.effective_message.text
+    )
+    CONTEXT.add(update.effective_chat.id, backlog, user, update.effective_message.text)
+    SUMMARIES.logged(update.effective_chat.id, backlog)
+    HISTORY.add(update.effective_chat.id, user, update.effective_message.text)
 
     logging.info(
         f"Added message to backlog of {update.effective_chat.title} "
@@ -150,8 +236,13 @@ async def log(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 async def clear(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    MESSAGE_BACKLOG[update.effective_chat.id] = []
-    update_messages_pickle()
+    MESSAGE_BACKLOG[update.effective_chat.id].clear()
+    record_change(context, "clear", update.effective_chat.id)
+    CONTEXT.reset(update.effective_chat.id)
+    SUMMARIES.reset(update.effective_chat.id)
+    HISTORY.reset(update.effective_chat.id)
+    # saved right away, a stale history would bring the dropped messages back
+    context.application.create_task(save_history_job(context))
     await context.bot.send_message(
         chat_id=update.effective_chat.id, text="Cleared backlog."
     )
@@ -161,48 +252,77 @@ async def clear(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 
-async def prompt_openai(
-    response_chat_id,
-    context: ContextTypes.DEFAULT_TYPE,
-    prompt: str,
-    engine: str = "gpt-3.5-turbo",
-):
+class CompletionFailed(Exception):
+    """
+    Raised with the message to show when no answer could be generated
+    """
+
+
+async def stream_completion(reply: StreamingReply, prompt: list, engine: str):
+    """
+    Streams the completion of prompt into reply and returns the complete text
+    """
+    text = ""
+    finish_reason = None
     try:
-        response = openai.ChatCompletion.create(
+        async for content, reason in COMPLETIONS.stream(
             model=engine,
             messages=prompt,
+        ):
+            text += content
+            finish_reason = reason or finish_reason
+            await reply.update(text)
+    except (openai.error.APIConnectionError, openai.error.Timeout):
+        raise CompletionFailed(
+            "I'm having trouble connecting to OpenAI's servers. "
+            + "Please try again later."
+        )
+    except openai.error.RateLimitError:
+        raise CompletionFailed(
+            "OpenAI is getting too many requests right now. "
+            + "Please try again later."
         )
+    except openai.error.OpenAIError as e:
+        logging.error(f"OpenAI request failed: {e.__class__.__name__} {e}")
+        raise CompletionFailed("Something went wrong while generating the answer.")
 
-        finish_reason = response["choices"][0]["finish_reason"]  # type: ignore
-        usage = response["usage"]["total_tokens"]  # type: ignore
-        summary = response["choices"][0]["message"]["content"]  # type: ignore
+    logging.info(
+        f"Finished summarizing with reason: {finish_reason}"
+        + f" and {len(text)} characters"
+    )
 
-        logging.info(
-            f"Finished summarizing with reason: {finish_reason}"
-            + f" and a usage: {usage} total tokens"
+    if finish_reason == "length":  # type: ignore
+        raise CompletionFailed(
+            "I couldn't generate a summary because the chat was too long."
         )
+    elif finish_reason == "content_filter":  # type: ignore
+        raise CompletionFailed(
+            "I couldn't generate a summary because the chat contained sensitive content."
+        )
+    elif not text.strip():
+        raise CompletionFailed("I couldn't come up with an answer.")
+    return text
 
-        if finish_reason == "length":  # type: ignore
-            await context.bot.send_message(
-                chat_id=response_chat_id,
-                text="I couldn't generate a summary because the chat was too long.",
-            )
-            return False, ""
-        elif finish_reason == "content_filter":  # type: ignore
-            await context.bot.send_message(
-                chat_id=response_chat_id,
-                text="I couldn't generate a summary because the chat contained sensitive content.",
-            )
-            return False, ""
-        else:
-            return True, summary
 
-    except openai.error.APIConnectionError:
-        await context.bot.send_message(
-            chat_id=response_chat_id,
-            text="I'm having trouble connecting to OpenAI's servers. "
-            + "Please try again later.",
+async def prompt_openai(
+    reply: StreamingReply,
+    prompt: list,
+    engine: str = "gpt-3.5-turbo",
+):
+    """
+    Answers prompt in reply, from the cache if the same prompt was just asked
+    """
+    try:
+        text = await RESPONSES.get_or_run(
+            RESPONSES.key(engine, prompt),
+            partial(stream_completion, reply, prompt, engine),
         )
+    except CompletionFailed as e:
+        await reply.fail(str(e))
+        return False, ""
+
+    await reply.finish(text)
+    return True, text
 
 
 async def summarize(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -231,27 +351,36 @@ async def summarize(update: Update, context: ContextTypes.DEFAULT_TYPE):
             chat_id=response_chat_id, text="I haven't seen any messages yet."
         )
     else:
-        await context.bot.send_message(
+        placeholder = await context.bot.send_message(
             chat_id=response_chat_id, text="Generating summary..."
         )
+        try:
+            summaries, tail = await SUMMARIES.split(update.effective_chat.id, backlog)
+        except openai.error.OpenAIError as e:
+            logging.warning(
+                f"Couldn't summarize older messages: {e.__class__.__name__} {e}"
+            )
+            summaries, tail = [], list(backlog)
+        # the newest messages that fit next to the summaries, but only from the tail
+        budget = CONTEXT.budget - sum(CONTEXT.count(summary) for summary in summaries)
+        messages = CONTEXT.pack(update.effective_chat.id, backlog, max(budget, 0))
+        messages = messages[-len(tail) :] if tail else []
+        covered = len(backlog) - len(tail) + len(messages)
 
         chat = [
             {
                 "role": "system",
                 "content": f"Summazrize the following chat conversation in {response_language}",
             },
-            {"role": "user", "content": format_backlog(backlog)},
+            {"role": "user", "content": format_summaries(summaries, messages)},
         ]
 
-        complete_answer, response = await prompt_openai(response_chat_id, context, chat)
-
-        if complete_answer:  # type: ignore
-            await context.bot.send_message(
-                chat_id=response_chat_id,
-                text=f"<b>Here is the summary of the last <i>{len(backlog)}</i> messages in {update.effective_chat.title}:</b>\n\n"
-                + f"{response}",  # type: ignore
-                parse_mode=ParseMode.HTML,
-            )
+        reply = StreamingReply(
+            context.bot,
+            placeholder,
+            header=f"<b>Here is the summary of the last <i>{covered}</i> messages in {html.escape(update.effective_chat.title or '')}:</b>\n\n",
+        )
+        await prompt_openai(reply, chat)
 
     await context.bot.delete_message(
         update.effective_chat.id, update.effective_message.id
@@ -279,6 +408,9 @@ async def prompt(update: Update, context: ContextTypes.DEFAULT_TYPE):
             chat_id=update.effective_chat.id, text="Answering prompt..."
         )
 
+        question = " ".join(context.args)  # type: ignore
+        relevant, recent = retrieve_context(update.effective_chat.id, backlog, question)
+
         chat = [
             {
                 "role": "system",
@@ -289,23 +421,13 @@ async def prompt(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     if backlog
                     else "The conversation has no context.\n"
                 )
-                + format_backlog(backlog),
+                + (f"{format_backlog(relevant)}\n...\n" if relevant else "")
+                + format_backlog(recent),
             },
-            {"role": "user", "content": (" ".join(context.args))},  # type: ignore
+            {"role": "user", "content": question},
         ]
 
-        complete_answer, response = await prompt_openai(
-            update.effective_chat.id, context, chat
-        )
-
-        if complete_answer:  # type: ignore
-            await context.bot.send_message(
-                chat_id=update.effective_chat.id,
-                text=f"{response}",  # type: ignore
-                parse_mode=ParseMode.HTML,
-            )
-
-        await context.bot.delete_message(update.effective_chat.id, temp_message.id)
+        await prompt_openai(StreamingReply(context.bot, temp_message), chat)
 
     logging.info(
         f"Sent promt to <{update.effective_user.name}> "
@@ -322,8 +444,46 @@ async def catch_all(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 
-def format_backlog(backlog: list):
-    return "\n".join([f"{name}: {message}" for name, message in backlog])
+def retrieve_context(chat_id, backlog: deque, question: str):
+    """
+    Returns the older messages most relevant to question and the newest
+    messages, both in chronological order and together within the token budget
+    """
+    recent = CONTEXT.pack(chat_id, backlog)[-RECENT_MESSAGES:]
+    budget = CONTEXT.budget - CONTEXT.newest_tokens(chat_id, len(recent))
+
+    relevant = []
+    for message_id, message in HISTORY.search(
+        chat_id, question, TOP_K, skip_latest=len(recent)
+    ):
+        tokens = CONTEXT.count(format_message(*message))
+        if tokens <= budget:
+            budget -= tokens
+            relevant.append((message_id, message))
+    relevant.sort()
+    return [message for _, message in relevant], recent
+
+
+def latest(backlog: deque, n: int):
+    """
+    Returns the last n messages without walking the whole backlog
+    """
+    return list(islice(reversed(backlog), n))[::-1]
+
+
+def format_backlog(backlog):
+    return "\n".join([format_message(name, message) for name, message in backlog])
+
+
+def format_summaries(summaries: list, backlog: list):
+    if not summaries:
+        return format_backlog(backlog)
+    return (
+        "Summaries of the earlier conversation:\n"
+        + "\n\n".join(summaries)
+        + "\n\nLatest messages:\n"
+        + format_backlog(backlog)
+    )
 
 
 class ListeningTo(filters.MessageFilter):
@@ -360,4 +520,12 @@ if __name__ == "__main__":
         MessageHandler(filters.ALL, catch_all),
     ]
 
-    pi_bot.start_bot("WitiBot", commands, LOG_FILE, token, post_init, handlers)
+    pi_bot.register_stats("backlog", backlog_stats)
+    pi_bot.register_stats("completions", COMPLETIONS.stats_snapshot)
+    pi_bot.register_stats("response cache", RESPONSES.stats_snapshot)
+    pi_bot.register_stats("context", CONTEXT.stats)
+    pi_bot.register_stats("summaries", lambda: SUMMARIES.stats)
+    pi_bot.register_stats("history", HISTORY.stats)
+    pi_bot.start_bot(
+        "WitiBot", commands, LOG_FILE, token, post_init, handlers, on_shutdown=shutdown
+    )